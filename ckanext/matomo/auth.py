@@ -0,0 +1,3 @@
+def matomo_tracking_stats(context, data_dict):
+    # Sysadmins only
+    return {'success': False}
@@ -0,0 +1,252 @@
+import copy
+import functools
+import hashlib
+import pickle
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple
+
+log = __import__('logging').getLogger(__name__)
+
+BACKEND_MEMORY = 'memory'
+BACKEND_REDIS = 'redis'
+BACKEND_NONE = 'none'
+DEFAULT_CACHE_BACKEND = BACKEND_MEMORY
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_ENTITY_CACHE_SIZE = 10000
+# How often in seconds the shared generation counter is read from Redis
+GENERATION_CHECK_INTERVAL = 10
+REDIS_KEY_PREFIX = 'ckanext-matomo'
+GENERATION_KEY = '{}:cache-generation'.format(REDIS_KEY_PREFIX)
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    '''
+    Thread safe in-process cache with a maximum number of entries and a time to live.
+    The least recently used entry is evicted when the cache is full.
+    '''
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: 'OrderedDict[Any, Tuple[float, Any]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ResultCache(object):
+    '''
+    Caches results of statistics queries and reports.
+
+    Entries are keyed on the cache generation, which is bumped whenever new
+    statistics are committed by fetch. The generation is shared between processes
+    through CKAN's Redis, so web workers stop using results computed before a fetch
+    in another process within GENERATION_CHECK_INTERVAL seconds. This also applies to the
+    memory backend, if Redis is unreachable its entries are only invalidated by ttl.
+    '''
+    def __init__(self, backend=DEFAULT_CACHE_BACKEND, ttl=DEFAULT_CACHE_TTL, maxsize=DEFAULT_CACHE_SIZE):
+        if backend not in (BACKEND_MEMORY, BACKEND_REDIS, BACKEND_NONE):
+            raise ValueError('Unknown cache backend: {}'.format(backend))
+        self.backend = backend
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.local_generation = 0
+        self.shared_generation: Optional[int] = None
+        self.generation_checked = 0.0
+        self.shared_generation_failed = False
+
+    def _redis(self):
+        from ckan.lib.redis import connect_to_redis
+        return connect_to_redis()
+
+    def generation(self) -> Tuple[int, int]:
+        now = time.monotonic()
+        if now - self.generation_checked > GENERATION_CHECK_INTERVAL:
+            self.generation_checked = now
+            try:
+                self.shared_generation = int(self._redis().get(GENERATION_KEY) or 0)
+                self.shared_generation_failed = False
+            except Exception as e:
+                # Warn once per outage instead of on every check
+                if not self.shared_generation_failed:
+                    log.warning('Could not read cache generation from redis, cached results are not invalidated '
+                                'by fetches in other processes: %s', e)
+                self.shared_generation_failed = True
+                self.shared_generation = None
+        return self.local_generation, self.shared_generation or 0
+
+    def check_shared_generation(self) -> bool:
+        '''
+        Checks that the shared cache generation can be read from Redis.
+        Raises RuntimeError for the redis backend and warns for the memory backend if it can't.
+        '''
+        try:
+            self._redis().get(GENERATION_KEY)
+        except Exception as e:
+            if self.backend == BACKEND_REDIS:
+                raise RuntimeError('Could not connect to redis for the matomo result cache: {}'.format(e))
+            log.warning('Could not connect to redis, cached matomo results are not invalidated when statistics '
+                        'are fetched in another process and expire only after %s seconds: %s', self.ttl, e)
+            return False
+        return True
+
+    def invalidate(self) -> None:
+        '''
+        Bumps the cache generation, making all previously cached results stale
+        '''
+        self.local_generation += 1
+        self.memory.clear()
+        try:
+            self.shared_generation = int(self._redis().incr(GENERATION_KEY))
+            self.generation_checked = time.monotonic()
+        except Exception as e:
+            log.warning('Could not bump cache generation in redis: %s', e)
+
+    def _key(self, name, args, kwargs):
+        return (name, self.generation(), repr(args), repr(sorted(kwargs.items())))
+
+    def _redis_key(self, key) -> str:
+        return '{}:cache:{}'.format(REDIS_KEY_PREFIX, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        if self.backend == BACKEND_MEMORY:
+            value = self.memory.get(key, _MISSING)
+            return value if value is _MISSING else copy.deepcopy(value)
+        if self.backend == BACKEND_REDIS:
+            try:
+                value = self._redis().get(self._redis_key(key))
+            except Exception as e:
+                log.warning('Could not read cached result from redis: %s', e)
+                return _MISSING
+            return _MISSING if value is None else pickle.loads(value)
+        return _MISSING
+
+    def set(self, key, value) -> None:
+        if self.backend == BACKEND_MEMORY:
+            self.memory.set(key, copy.deepcopy(value))
+        elif self.backend == BACKEND_REDIS:
+            try:
+                self._redis().set(self._redis_key(key), pickle.dumps(value), ex=self.ttl)
+            except Exception as e:
+                log.warning('Could not write cached result to redis: %s', e)
+
+    def call(self, name: str, function: Callable, *args, **kwargs):
+        if self.backend == BACKEND_NONE:
+            return function(*args, **kwargs)
+        key = self._key(name, args, kwargs)
+        value = self.get(key)
+        if value is _MISSING:
+            value = function(*args, **kwargs)
+            self.set(key, value)
+        return value
+
+
+_result_cache = ResultCache()
+_entity_cache = ResultCache(maxsize=DEFAULT_ENTITY_CACHE_SIZE)
+
+
+def configure(backend=DEFAULT_CACHE_BACKEND, ttl=DEFAULT_CACHE_TTL, maxsize=DEFAULT_CACHE_SIZE,
+              entity_maxsize=DEFAULT_ENTITY_CACHE_SIZE) -> ResultCache:
+    '''
+    Replaces the process-wide result and entity caches with ones created with the given options
+    '''
+    global _result_cache, _entity_cache
+    _result_cache = ResultCache(backend=backend, ttl=ttl, maxsize=maxsize)
+    _entity_cache = ResultCache(backend=backend, ttl=ttl, maxsize=entity_maxsize)
+    # fetch runs in a separate process and invalidates the caches of web workers through Redis
+    if backend != BACKEND_NONE:
+        _result_cache.check_shared_generation()
+    return _result_cache
+
+
+def get_result_cache() -> ResultCache:
+    return _result_cache
+
+
+def get_entity_cache() -> ResultCache:
+    return _entity_cache
+
+
+def invalidate() -> None:
+    _result_cache.invalidate()
+    _entity_cache.invalidate()
+
+
+def _function_name(function: Callable) -> str:
+    return '{}.{}'.format(function.__module__, function.__qualname__)
+
+
+def cached(function: Callable) -> Callable:
+    '''
+    Caches the results of the decorated function in the result cache, keyed on its arguments
+    '''
+    name = _function_name(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return _result_cache.call(name, function, *args, **kwargs)
+
+    return wrapper
+
+
+def request_memoized(function: Callable) -> Callable:
+    '''
+    Memoizes the results of the decorated function for the duration of the current request
+    '''
+    from flask import g, has_request_context
+    name = _function_name(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not has_request_context():
+            return function(*args, **kwargs)
+        memo = g.setdefault('matomo_memo', {})
+        key = (name, repr(args), repr(sorted(kwargs.items())))
+        if key not in memo:
+            memo[key] = function(*args, **kwargs)
+        return memo[key]
+
+    return wrapper
+
+
+def entity_cached(function: Callable) -> Callable:
+    '''
+    Caches per dataset or resource statistics in the bounded entity cache
+    and memoizes them for the duration of the current request
+    '''
+    name = _function_name(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return _entity_cache.call(name, function, *args, **kwargs)
+
+    return request_memoized(wrapper)
@@ -22,5 +22,21 @@ def matomo():
 @click.option(u'--since', help="First date to fetch in YYYY-MM-DD format. Default: latest PackageStats entry date.")
 @click.option(u'--until', help="Last date to fetch in YYYY-MM-DD format. Default: current date.")
 @click.option(u'--dataset', required=False, help="Fetch analytics data for a single dataset")
-def fetch(dryrun, since, until, dataset):
-    commands.fetch(dryrun, since, until, dataset)
+@click.option(u'--commit-every', type=click.IntRange(min=1), required=False,
+              help="Also commit after every N written rows within a day. Default: one transaction per day of data.")
+@click.option(u'--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help="Number of concurrent requests to Matomo.")
+@click.option(u'--chunk-days', type=click.IntRange(min=1), required=False,
+              help="Fetch and process the date range in windows of N days. Default: the whole range at once.")
+@click.option(u'--bulk', is_flag=True, help="Request all reports of a date window with one bulk API request.")
+def fetch(dryrun, since, until, dataset, commit_every, workers, chunk_days, bulk):
+    commands.fetch(dryrun, since, until, dataset, commit_every=commit_every, workers=workers, chunk_days=chunk_days,
+                   bulk=bulk)
+
+
+@matomo.command(
+    u'flush-tracking',
+    help='Sends tracking events from the local spool to Matomo'
+)
+def flush_tracking():
+    commands.flush_tracking()
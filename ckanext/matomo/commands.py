@@ -1,16 +1,259 @@
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dateutil.relativedelta import relativedelta
+from functools import partial
 from urllib.parse import unquote
 import re
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
-from ckanext.matomo.matomo_api import MatomoAPI
+from sqlalchemy import or_
+from ckanext.matomo import cache
+from ckanext.matomo.matomo_api import MatomoAPI, MatomoRequest, DEFAULT_TIMEOUT
 from ckanext.matomo.model import PackageStats, ResourceStats, AudienceLocationDate, SearchStats
-from typing import Dict, Any, List
+from ckanext.matomo.types import PackageInfo, ResourceInfo
+from typing import Dict, Any, List, Iterable, Iterator, Callable, NamedTuple, Optional, Tuple
 
 DATE_FORMAT = '%Y-%m-%d'
+# Maximum number of names or ids passed to a single IN clause when resolving packages
+LOOKUP_CHUNK_SIZE = 1000
+PACKAGE_SHOW_EVENT_PATTERN = re.compile('.*id=([a-zA-Z0-9-_]*)&?.*$', re.I)
+DATASTORE_SEARCH_SQL_EVENT_PATTERN = re.compile('^.*FROM "([a-zA-Z0-9-_]*)".*$', re.I | re.M)
+DATASTORE_SEARCH_EVENT_PATTERN = re.compile('.*resource_id=([a-zA-Z0-9-_]*)&?.*$', re.I)
 
 log = __import__('logging').getLogger(__name__)
 
-def fetch(dryrun, since, until, dataset):
+
+def _chunks(items: List[str], size: int) -> Iterable[List[str]]:
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def resolve_packages(names_or_ids: Iterable[str]) -> Dict[str, PackageInfo]:
+    '''
+    Resolves package names and ids to basic package info using batched queries
+    instead of calling package_show for every single package.
+
+    :param names_or_ids: package names and/or ids
+    :return: {name_or_id: {id: str, name: str, type: str, owner_org: str}, ...}
+             Packages are available by both their id and name.
+    '''
+    keys = sorted({key for key in names_or_ids if key})
+    packages: Dict[str, PackageInfo] = {}
+
+    for chunk in _chunks(keys, LOOKUP_CHUNK_SIZE):
+        rows = (model.Session.query(model.Package.id, model.Package.name,
+                                    model.Package.type, model.Package.owner_org)
+                .filter(or_(model.Package.id.in_(chunk), model.Package.name.in_(chunk)))
+                .all())
+        for row in rows:
+            info: PackageInfo = {'id': row.id, 'name': row.name, 'type': row.type, 'owner_org': row.owner_org}
+            packages[row.id] = info
+            packages[row.name] = info
+
+    return packages
+
+
+def resolve_resources(resource_ids: Iterable[str]) -> Dict[str, ResourceInfo]:
+    '''
+    Looks up existing resources using batched queries instead of calling
+    resource_show for every single resource.
+
+    :param resource_ids: resource ids
+    :return: {resource_id: {package_id: str, state: str}, ...} for active resources
+    '''
+    ids = sorted({resource_id for resource_id in resource_ids if resource_id})
+    resources: Dict[str, ResourceInfo] = {}
+
+    for chunk in _chunks(ids, LOOKUP_CHUNK_SIZE):
+        rows = (model.Session.query(model.Resource.id, model.Resource.package_id, model.Resource.state)
+                .filter(model.Resource.id.in_(chunk))
+                .filter(model.Resource.state == 'active')
+                .all())
+        for row in rows:
+            resources[row.id] = {'package_id': row.package_id, 'state': row.state}
+
+    return resources
+
+
+def _datastore_event_resource_id(event: Dict[str, Any]):
+    if event.get('Events_EventAction') == "datastore_search_sql":
+        pattern = DATASTORE_SEARCH_SQL_EVENT_PATTERN
+    elif event.get('Events_EventAction') == "datastore_search":
+        pattern = DATASTORE_SEARCH_EVENT_PATTERN
+    else:
+        return None
+
+    match = pattern.search(unquote(event.get('Events_EventName') or ''))
+    if match and match[1]:
+        return match[1]
+    return None
+
+
+def _update_location_visits(rows) -> None:
+    for location_name, visit_date, visits in rows:
+        AudienceLocationDate.update_visits(location_name, visit_date, visits)
+
+
+def _update_search_term_counts(rows) -> None:
+    for search_term, search_date, count in rows:
+        SearchStats.update_search_term_count(search_term, search_date, count)
+
+
+class StatsTarget(NamedTuple):
+    name: str
+    write: Callable[[List[Any]], Any]
+
+
+# Targets are written in this order for every day, later rows override earlier ones
+PACKAGE_STATS = StatsTarget('package stats', PackageStats.bulk_upsert)
+PACKAGE_DOWNLOADS = StatsTarget('package downloads', partial(PackageStats.bulk_upsert, fields=('downloads',)))
+PACKAGE_EVENTS = StatsTarget('package events', partial(PackageStats.bulk_upsert, fields=('events',)))
+RESOURCE_DOWNLOADS = StatsTarget('resource downloads', partial(ResourceStats.bulk_upsert, fields=('downloads',)))
+RESOURCE_VISITS = StatsTarget('resource visits', partial(ResourceStats.bulk_upsert, fields=('visits',)))
+RESOURCE_EVENTS = StatsTarget('resource events', partial(ResourceStats.bulk_upsert, fields=('events',)))
+LOCATION_VISITS = StatsTarget('location visits', _update_location_visits)
+SEARCH_TERMS = StatsTarget('search terms', _update_search_term_counts)
+STATS_TARGETS = (PACKAGE_STATS, PACKAGE_DOWNLOADS, PACKAGE_EVENTS,
+                 RESOURCE_DOWNLOADS, RESOURCE_VISITS, RESOURCE_EVENTS,
+                 LOCATION_VISITS, SEARCH_TERMS)
+
+
+class StatsWriter(object):
+    '''
+    Collects stat rows by date and writes them one day at a time.
+
+    By default every day of data is written in its own transaction, so a failing
+    or interrupted fetch leaves whole days either written or not written.
+    With commit_every the session is also committed after every commit_every rows within a day,
+    so a failing day may be partially written, but rows of other days are never rolled back with it.
+    '''
+    def __init__(self, commit_every: Optional[int] = None):
+        if commit_every is not None and commit_every < 1:
+            raise ValueError('commit_every must be at least 1, got {}'.format(commit_every))
+        self.commit_every = commit_every
+        self.rows_by_date: Dict[str, Dict[StatsTarget, List[Any]]] = {}
+        self.pending = 0
+
+    def add(self, date_str: str, target: StatsTarget, row) -> None:
+        self.rows_by_date.setdefault(date_str, {}).setdefault(target, []).append(row)
+
+    def _commit(self) -> None:
+        if self.pending:
+            model.Session.commit()
+            log.debug('Committed %d rows', self.pending)
+            # Cached statistics and reports are stale after new rows are committed
+            cache.invalidate()
+        self.pending = 0
+
+    def write(self) -> None:
+        for date_str in sorted(self.rows_by_date):
+            rows_by_target = self.rows_by_date[date_str]
+            try:
+                for target in STATS_TARGETS:
+                    rows = rows_by_target.get(target, [])
+                    if not rows:
+                        continue
+                    for chunk in _chunks(rows, self.commit_every or len(rows)):
+                        target.write(chunk)
+                        self.pending += len(chunk)
+                        if self.commit_every and self.pending >= self.commit_every:
+                            self._commit()
+                # Every day ends its own transaction, a failing day must not roll back earlier days
+                self._commit()
+            except Exception as e:
+                log.exception('Error writing statistics for {}, rolling back {} uncommitted rows of the day: {}'
+                              .format(date_str, self.pending, e))
+                model.Session.rollback()
+                self.pending = 0
+        self.rows_by_date = {}
+
+
+def _dataset_page_package_name(label: str) -> str:
+    return label.split('?')[0].strip()
+
+
+def _package_show_event_package_id(event: Dict[str, Any]):
+    match = PACKAGE_SHOW_EVENT_PATTERN.match(event.get('Events_EventName') or '')
+    if match and match[1]:
+        return match[1]
+    return None
+
+
+def date_windows(since_date: datetime.date, until_date: datetime.date,
+                 chunk_days: Optional[int] = None) -> List[Tuple[datetime.date, datetime.date]]:
+    '''
+    Splits the date range into consecutive windows of at most chunk_days days.
+    Without chunk_days the whole range is returned as a single window.
+    '''
+    if chunk_days is None:
+        return [(since_date, until_date)]
+    if chunk_days < 1:
+        raise ValueError('chunk_days must be at least 1, got {}'.format(chunk_days))
+
+    windows = []
+    window_start = since_date
+    while window_start <= until_date:
+        window_end = min(window_start + datetime.timedelta(days=chunk_days - 1), until_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + datetime.timedelta(days=1)
+    return windows
+
+
+def _report_requests(api: MatomoAPI, dataset: Optional[str],
+                     pkg: Optional[PackageInfo]) -> Dict[str, Callable[..., MatomoRequest]]:
+    report_requests = {
+        'dataset_page_statistics': partial(api.dataset_page_statistics_request, dataset=dataset),
+        # Resource downloads use package id in its url
+        'resource_download_statistics': partial(api.resource_download_statistics_request,
+                                                dataset=pkg['id'] if pkg else None),
+        'package_show_events': partial(api.events_request, filter_pattern='package_show'),
+        'resource_page_statistics': partial(api.resource_page_statistics_request, dataset=dataset),
+        # pattern is used as regex so it includes both datastore_search and datastore_search_sql
+        'datastore_search_sql_events': partial(api.events_request, filter_pattern='datastore_search'),
+    }
+    if not dataset:
+        report_requests['visits_by_country'] = api.visits_by_country_request
+        report_requests['search_terms'] = api.search_terms_request
+    return report_requests
+
+
+def fetch_reports(api: MatomoAPI,
+                  report_requests: Dict[str, Callable[..., MatomoRequest]],
+                  windows: List[Tuple[datetime.date, datetime.date]],
+                  workers: int = 1,
+                  bulk: bool = False) -> Iterator[Tuple[Tuple[datetime.date, datetime.date], Dict[str, Any]]]:
+    '''
+    Fetches every report for every date window using a bounded thread pool.
+    Reports for the next window are requested while the current one is being processed,
+    so at most two windows of responses are kept in memory at a time.
+
+    :param bulk: request all reports of a window with a single API.getBulkRequest call
+    :return: iterator of (window, {report_name: report_data})
+    '''
+    def submit(executor, window):
+        params = {'period': 'day', 'date': MatomoAPI.date_range(*window)}
+        matomo_requests = {name: request(**params) for name, request in report_requests.items()}
+        if bulk:
+            return executor.submit(api.bulk, matomo_requests)
+        return {name: executor.submit(api.execute, request) for name, request in matomo_requests.items()}
+
+    def result(submitted):
+        if bulk:
+            return submitted.result()
+        return {name: future.result() for name, future in submitted.items()}
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending = submit(executor, windows[0]) if windows else None
+        for index, window in enumerate(windows):
+            current = pending
+            if index + 1 < len(windows):
+                pending = submit(executor, windows[index + 1])
+            yield window, result(current)
+
+
+def fetch(dryrun, since, until, dataset=None, commit_every=None, workers=1, chunk_days=None, bulk=False):
+    until_date = datetime.datetime.strptime(until, DATE_FORMAT).date() if until else datetime.date.today()
+
     if since:
         since_date = datetime.datetime.strptime(since, DATE_FORMAT).date()
     else:
@@ -18,42 +261,69 @@ def fetch(dryrun, since, until, dataset):
         if latest_update_datetime is not None:
             since_date = latest_update_datetime.date()
         else:
-            since_date = 'lastYear'
-
-    until_date = datetime.datetime.strptime(until, DATE_FORMAT).date() if until else datetime.date.today()
+            since_date = until_date - relativedelta(years=1)
 
-    if isinstance(since_date, datetime.date) and isinstance(until_date, datetime.date) and since_date > until_date:
+    if since_date > until_date:
         log.info('Start date must not be greater than end date')
         return
 
     matomo_url = toolkit.config.get('ckanext.matomo.api_domain') or toolkit.config.get('ckanext.matomo.domain')
     matomo_site_id = toolkit.config.get('ckanext.matomo.site_id')
     matomo_token_auth = toolkit.config.get('ckanext.matomo.token_auth')
-    api = MatomoAPI(matomo_url, matomo_site_id, matomo_token_auth)
-    params = {'period': 'day', 'date': MatomoAPI.date_range(since_date, until_date)}
-    package_show = toolkit.get_action('package_show')
-    resource_show = toolkit.get_action('resource_show')
-
-    # Dataset stats
-
-    dataset_page_statistics: Dict[str, Any] = api.dataset_page_statistics(**params, dataset=dataset)
+    api = MatomoAPI(matomo_url, matomo_site_id, matomo_token_auth,
+                    timeout=float(toolkit.config.get('ckanext.matomo.api_timeout', DEFAULT_TIMEOUT)))
 
     pkg = None
     if dataset:
-        try:
-            pkg = package_show({'ignore_auth': True}, {'id': dataset})
-        except toolkit.ObjectNotFound:
+        pkg = resolve_packages([dataset]).get(dataset)
+        if pkg is None:
             log.info("Given dataset: %s not found" % dataset)
-            pass
 
-
-    # Resource downloads use package id in its url
-    resource_download_statistics: Dict[str, Any] = api.resource_download_statistics(**params,
-                                                                                    dataset=pkg['id'] if pkg else None)
-    package_show_events: Dict[str, Any] = api.events(**params, filter_pattern='package_show')
+    # Stats are collected here and written day by day once a window has been parsed
+    writer = StatsWriter(commit_every=commit_every)
+    report_requests = _report_requests(api, dataset, pkg)
+
+    for (window_start, window_end), reports in fetch_reports(api, report_requests,
+                                                             date_windows(since_date, until_date, chunk_days),
+                                                             workers, bulk):
+        log.info('Processing statistics for %s - %s', window_start, window_end)
+        _parse_statistics(reports, writer, dryrun, dataset, pkg)
+        if not dryrun:
+            writer.write()
+
+
+def _parse_statistics(reports: Dict[str, Any], writer: StatsWriter, dryrun: bool,
+                      dataset: Optional[str], pkg: Optional[PackageInfo]) -> None:
+    dataset_page_statistics: Dict[str, Any] = reports['dataset_page_statistics']
+    resource_download_statistics: Dict[str, Any] = reports['resource_download_statistics']
+    package_show_events: Dict[str, Any] = reports['package_show_events']
+    resource_page_statistics: Dict[str, Any] = reports['resource_page_statistics']
+    datastore_search_sql_events: Dict[str, Any] = reports['datastore_search_sql_events']
+
+    # Resolve every package referenced in the responses up front
+    package_keys = set()
+    for date_statistics in dataset_page_statistics.values():
+        package_keys.update(_dataset_page_package_name(package_name) for package_name in date_statistics)
+    for date_statistics in resource_download_statistics.values():
+        package_keys.update(date_statistics)
+    for date_statistics in package_show_events.values():
+        package_keys.update(_package_show_event_package_id(stats) for stats in date_statistics)
+    packages = resolve_packages(package_keys)
+
+    # Look up every resource referenced in the responses with a single pass
+    resource_ids = set()
+    for date_statistics in resource_download_statistics.values():
+        for stats_list in date_statistics.values():
+            resource_ids.update(stats_list)
+    for date_statistics in resource_page_statistics.values():
+        resource_ids.update(date_statistics)
+    for date_statistics in datastore_search_sql_events.values():
+        resource_ids.update(_datastore_event_resource_id(event) for event in date_statistics)
+    resources = resolve_resources(resource_ids)
 
     updated_package_ids_by_date = {}
 
+
     # Parse visits for datasets
     for date_str, date_statistics in dataset_page_statistics.items():
         date = datetime.datetime.strptime(date_str, DATE_FORMAT)
@@ -61,14 +331,13 @@ def fetch(dryrun, since, until, dataset):
         updated_package_ids_by_date[date_str] = updated_package_ids
 
         for package_name, stats_list in date_statistics.items():
-            package_name = package_name.split('?')[0]
-            if not package_name.strip():
+            package_name = _dataset_page_package_name(package_name)
+            if not package_name:
                 continue
 
             try:
-                try:
-                    package = package_show({'ignore_auth': True}, {'id': package_name})
-                except toolkit.ObjectNotFound:
+                package = packages.get(package_name)
+                if package is None:
                     log.info('Package "{}" not found, skipping...'.format(package_name))
                     continue
                 if package.get('type') == 'dataset':
@@ -95,7 +364,7 @@ def fetch(dryrun, since, until, dataset):
                                  'entrances={}, downloads={}, events={}'
                             .format(package_id, date, visits, entrances, downloads, events))
                     else:
-                        PackageStats.create_or_update(package_id, date, visits, entrances, downloads, events)
+                        writer.add(date_str, PACKAGE_STATS, (package_id, date, visits, entrances, downloads, events))
 
                     updated_package_ids.add(package_id)
             except Exception as e:
@@ -107,17 +376,13 @@ def fetch(dryrun, since, until, dataset):
         updated_package_ids = updated_package_ids_by_date.get(date_str, set())
 
         for package_id, stats_list in date_statistics.items():
-            try:
-                package = package_show({'ignore_auth': True}, {'id': package_id})
-            except toolkit.ObjectNotFound:
+            if package_id not in packages:
                 log.info('Package "{}" not found, skipping...'.format(package_id))
                 continue
 
             # Add download-stats for every resources
             for resource_id, resource_stats in stats_list.items():
-                try:
-                    resource_show({'ignore_auth': True}, {'id': resource_id})
-                except toolkit.ObjectNotFound:
+                if resource_id not in resources:
                     log.info('Resource "{}" not found, skipping...'.format(resource_id))
                     continue
                 try:
@@ -127,7 +392,7 @@ def fetch(dryrun, since, until, dataset):
                                  'resource_id={}, date={}, downloads={}'
                               .format(package_id, resource_id, date, downloads))
                     else:
-                        ResourceStats.update_downloads(resource_id, date, downloads)
+                        writer.add(date_str, RESOURCE_DOWNLOADS, (resource_id, date, downloads))
                 except Exception as e:
                     log.exception('Error updating resource statistics for {}: {}'.format(resource_id, e))
 
@@ -142,7 +407,7 @@ def fetch(dryrun, since, until, dataset):
                         log.info('Would update download stats: package_id={}, date={}, downloads={}'
                             .format(package_id, date, downloads))
                     else:
-                        PackageStats.update_downloads(package_id, date, downloads)
+                        writer.add(date_str, PACKAGE_DOWNLOADS, (package_id, date, downloads))
                 except Exception as e:
                     log.exception('Error updating download statistics for {}: {}'.format(package_id, e))
 
@@ -152,15 +417,12 @@ def fetch(dryrun, since, until, dataset):
         updated_package_ids = updated_package_ids_by_date.get(date_str, set())
 
         for stats in date_statistics:
-            regex = re.compile('.*id=([a-zA-Z0-9-_]*)&?.*$', re.I)
-            match = regex.match(stats.get('Events_EventName'))
-            if match and match[1]:
-                if dataset and dataset != match[1]:
+            package_id_or_name = _package_show_event_package_id(stats)
+            if package_id_or_name:
+                if dataset and dataset != package_id_or_name:
                     continue
-                package_id_or_name = match[1]
-                try:
-                    package = package_show({'ignore_auth': True}, {'id': package_id_or_name})
-                except toolkit.ObjectNotFound:
+                package = packages.get(package_id_or_name)
+                if package is None:
                     log.info('Package "{}" not found, skipping...'.format(package_id_or_name))
                     continue
                 package_id = package.get('id')
@@ -172,21 +434,14 @@ def fetch(dryrun, since, until, dataset):
                             log.info('Would create or update: package_id={}, date={}, events={}'
                                 .format(package_id, date, events))
                         else:
-                            PackageStats.update_events(package_id, date, events)
+                            writer.add(date_str, PACKAGE_EVENTS, (package_id, date, events))
                     except Exception as e:
                         log.exception('Error updating API event statistics for {}: {}'.format(package_id, e))
 
-    # Resource page statistics
-    resource_page_statistics = api.resource_page_statistics(**params, dataset=dataset)
-    # pattern is used as regex so it includes both datastore_search and datastore_search_sql
-    datastore_search_sql_events: Dict[str, Any] = api.events(**params, filter_pattern='datastore_search')
-
     for date_str, date_statistics in resource_page_statistics.items():
         date = datetime.datetime.strptime(date_str, DATE_FORMAT)
         for resource_id, stats_list in date_statistics.items():
-            try:
-                resource_show({'ignore_auth': True}, {'id': resource_id})
-            except toolkit.ObjectNotFound:
+            if resource_id not in resources:
                 log.info('Resource "{}" not found, skipping...'.format(resource_id))
                 continue
             try:
@@ -194,7 +449,7 @@ def fetch(dryrun, since, until, dataset):
                 if dryrun:
                     log.info('Would create or update: resource_id={}, date={}, visits={}'.format(resource_id, date, visits))
                 else:
-                    ResourceStats.update_visits(resource_id, date, visits)
+                    writer.add(date_str, RESOURCE_VISITS, (resource_id, date, visits))
             except Exception as e:
                 log.exception('Error updating resource statistics for {}: {}'.format(resource_id, e))
 
@@ -203,29 +458,17 @@ def fetch(dryrun, since, until, dataset):
         date = datetime.datetime.strptime(date_str, DATE_FORMAT)
 
         for event in date_statistics:
-            resource_id = None
-            if event.get('Events_EventAction') == "datastore_search_sql":
-                regex = re.compile('^.*FROM "([a-zA-Z0-9-_]*)".*$', re.I|re.M)
-                match = regex.search(unquote(event.get('Events_EventName')))
-                if match and match[1]:
-                    resource_id = match[1]
-            elif event.get('Events_EventAction') == "datastore_search":
-                regex = re.compile('.*resource_id=([a-zA-Z0-9-_]*)&?.*$', re.I)
-                match = regex.search(unquote(event.get('Events_EventName')))
-                if match and match[1]:
-                    resource_id = match[1]
-            else:
+            resource_id = _datastore_event_resource_id(event)
+            if resource_id is None:
                 log.info("No resource_id found from EventName, skipping...")
                 continue
 
-            try:
-                resource = resource_show({'ignore_auth': True}, {'id': resource_id})
-                if pkg:
-                    if pkg['id'] != resource['package_id']:
-                        continue
-            except toolkit.ObjectNotFound:
+            resource = resources.get(resource_id)
+            if resource is None:
                 log.info('Resource "{}" not found, skipping...'.format(resource_id))
                 continue
+            if pkg and pkg['id'] != resource['package_id']:
+                continue
             # Add event stats for resourcee
             try:
                 events = event.get('nb_events', 0)
@@ -233,13 +476,13 @@ def fetch(dryrun, since, until, dataset):
                     log.info('Would create or update: resource_id={}, date={}, events={}'
                         .format(resource_id, date, events))
                 else:
-                    ResourceStats.update_events(resource_id, date, events)
+                    writer.add(date_str, RESOURCE_EVENTS, (resource_id, date, events))
             except Exception as e:
                 log.exception('Error updating API event statistics for resource {}: {}'.format(resource_id, e))
 
     if not dataset:
         # Visits by country
-        visits_by_country = api.visits_by_country(**params)
+        visits_by_country: Dict[str, Any] = reports['visits_by_country']
 
         for date_str, date_statistics in visits_by_country.items():
             date = datetime.datetime.strptime(date_str, DATE_FORMAT)
@@ -252,12 +495,12 @@ def fetch(dryrun, since, until, dataset):
                         log.info("Would update country statistics: date={}, country={}, visits={}"
                               .format(date, country_name, visits))
                     else:
-                        AudienceLocationDate.update_visits(country_name, date, visits)
+                        writer.add(date_str, LOCATION_VISITS, (country_name, date, visits))
                 except Exception as e:
                     log.exception('Error updating country statistics for {}: {}'.format(country_name, e))
 
         # Search terms
-        search_terms = api.search_terms(**params)
+        search_terms: Dict[str, Any] = reports['search_terms']
 
         for date_str, date_statistics in search_terms.items():
             date = datetime.datetime.strptime(date_str, DATE_FORMAT)
@@ -270,11 +513,17 @@ def fetch(dryrun, since, until, dataset):
                         log.info("Would search term statistics: date={}, search_term={}, count={}"
                               .format(date, search_term, count))
                     else:
-                        SearchStats.update_search_term_count(search_term, date, count)
+                        writer.add(date_str, SEARCH_TERMS, (search_term, date, count))
                 except Exception as e:
                     log.exception('Error updating search term statistics for {}: {}'.format(search_term, e))
 
 
+def flush_tracking():
+    from ckanext.matomo.tracking import flush_tracking_spool
+    result = flush_tracking_spool()
+    log.info('Sent {sent} spooled tracking events, {failed} failed and were left in the spool'.format(**result))
+
+
 def init_db():
     from ckanext.matomo.model import init_tables
     import ckan.model as model
@@ -1,11 +1,12 @@
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 from flask import request
 from typing import List, Tuple, Optional
 from ckan.plugins.toolkit import render_snippet, config
 from ckan.plugins import toolkit as tk
+from ckanext.matomo.cache import entity_cached
 from ckanext.matomo.utils import last_calendar_period, get_report_years
-from ckanext.matomo.model import PackageStats, ResourceStats, get_end_of_last_week, get_beginning_of_next_week
-from ckanext.matomo.types import Visits
+from ckanext.matomo.model import PackageStats, ResourceStats, get_last_year_weeks
+from ckanext.matomo.types import Visit, Visits
 
 
 def matomo_snippet():
@@ -32,37 +33,67 @@ def get_organization_url(organization: str) -> str:
     return tk.url_for(organization_path)
 
 
-def get_visits_for_dataset(id: str) -> Visits:
+# The cached statistics functions take the current day as an argument to key the cache on it,
+# as the reported date ranges are relative to the current date
+
+@entity_cached
+def _dataset_visits(id: str, day: date) -> Visits:
     return PackageStats.get_all_visits(id)
 
 
-def get_visits_for_resource(id: str) -> Visits:
+@entity_cached
+def _resource_visits(id: str, day: date) -> Visits:
     return ResourceStats.get_all_visits(id)
 
+
+@entity_cached
+def _resource_downloads_in_date_range(id: str, day: date) -> Visits:
+    start_date, end_date = get_last_year_weeks(datetime.now())
+    return ResourceStats.get_downloads_in_date_range_by_id(id, start_date, end_date)
+
+
+@entity_cached
+def _dataset_download_count(id: str, time: str, day: date) -> int:
+    start_date, end_date = last_calendar_period(time)
+    return ResourceStats.get_download_count_for_dataset(id, start_date, end_date)
+
+
+@entity_cached
+def _dataset_visit_count(id: str, time: str, day: date) -> int:
+    start_date, end_date = last_calendar_period(time)
+    return PackageStats.get_visit_count_for_dataset(id, start_date, end_date)
+
+
+@entity_cached
+def _resource_stat_counts(id: str, time: str, day: date) -> Visit:
+    start_date, end_date = last_calendar_period(time)
+    return ResourceStats.get_stat_counts_by_id_and_date_range(id, start_date, end_date)
+
+
+def get_visits_for_dataset(id: str) -> Visits:
+    return _dataset_visits(id, date.today())
+
+
+def get_visits_for_resource(id: str) -> Visits:
+    return _resource_visits(id, date.today())
+
 def get_downloads_in_date_range_for_resource(id: str) -> Visits:
-    end_of_last_week = get_end_of_last_week(datetime.now())
-    start_date = get_beginning_of_next_week(end_of_last_week.replace(hour=0, minute=0, second=0, microsecond=0)
-                                            - timedelta(days=365))
-    return ResourceStats.get_downloads_in_date_range_by_id(id, start_date, end_of_last_week)
+    return _resource_downloads_in_date_range(id, date.today())
 
 def get_download_count_for_dataset(id: str, time: str) -> int:
-    start_date, end_date = get_date_range(time)
-    return ResourceStats.get_download_count_for_dataset(id, start_date, end_date)
+    return _dataset_download_count(id, get_time_option(time), date.today())
 
 
 def get_visit_count_for_dataset(id: str, time: str) -> int:
-    start_date, end_date = get_date_range(time)
-    return PackageStats.get_visit_count_for_dataset(id, start_date, end_date)
+    return _dataset_visit_count(id, get_time_option(time), date.today())
 
 
 def get_download_count_for_resource(id: str, time: str) -> int:
-    start_date, end_date = get_date_range(time)
-    return ResourceStats.get_stat_counts_by_id_and_date_range(id, start_date, end_date).get('downloads', 0)
+    return _resource_stat_counts(id, get_time_option(time), date.today()).get('downloads', 0)
 
 
 def get_visit_count_for_resource(id: str, time: str) -> int:
-    start_date, end_date = get_date_range(time)
-    return ResourceStats.get_stat_counts_by_id_and_date_range(id, start_date, end_date).get('visits', 0)
+    return _resource_stat_counts(id, get_time_option(time), date.today()).get('visits', 0)
 
 
 def format_date(datestr) -> str:
@@ -70,11 +101,15 @@ def format_date(datestr) -> str:
     return dateobj.strftime('%d-%m-%Y')
 
 
-def get_date_range(time: Optional[str] = None) -> Tuple[datetime, datetime]:
+def get_time_option(time: Optional[str] = None) -> str:
     if not time:
         params = dict(list(request.args.items()))
         time = params.get('time', 'month')
-    return last_calendar_period(time)
+    return time
+
+
+def get_date_range(time: Optional[str] = None) -> Tuple[datetime, datetime]:
+    return last_calendar_period(get_time_option(time))
 
 
 def get_years() -> List[str]:
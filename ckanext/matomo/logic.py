@@ -1,32 +1,116 @@
 from datetime import datetime
 from operator import itemgetter
+from typing import Any, Dict, List
 import ckan.plugins.toolkit as toolkit
+from ckanext.matomo.cache import cached
 from ckanext.matomo.model import PackageStats
+from ckanext.matomo.tracking import get_tracking_dispatcher
 from ckanext.matomo.types import Visits
 
+# Top packages only change when statistics are fetched, package dicts are not cached
+# as their content depends on the user and the current package state
+_get_top_packages = cached(PackageStats.get_top)
+
+# Number of packages fetched with a single package_search, below the default ckan.search.rows_max
+SEARCH_CHUNK_SIZE = 100
+PACKAGE_SUMMARY_FIELDS = ('id', 'name', 'title', 'title_translated', 'owner_org', 'metadata_modified')
+
+
+def _summary_fields(fields) -> List[str]:
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+    if not isinstance(fields, list):
+        raise toolkit.ValidationError({'fields': ['Must be a list or a comma separated string']})
+
+    unknown = [field for field in fields if field not in PACKAGE_SUMMARY_FIELDS]
+    if unknown:
+        raise toolkit.ValidationError({'fields': ['Unknown fields: {}'.format(', '.join(unknown))]})
+
+    return ['id'] + [field for field in fields if field != 'id']
+
+
+def _search_packages_by_id(context, package_ids, dataset_type) -> Dict[str, Dict[str, Any]]:
+    '''
+    Fetches package dicts with package_search in chunks that fit in the search rows limit.
+    Packages the search doesn't return, e.g. ones not indexed yet, are fetched with package_show
+    so that the result matches fetching every package with package_show.
+    '''
+    packages: Dict[str, Dict[str, Any]] = {}
+    for index in range(0, len(package_ids), SEARCH_CHUNK_SIZE):
+        chunk = package_ids[index:index + SEARCH_CHUNK_SIZE]
+        fq = '+id:({}) +dataset_type:{}'.format(' OR '.join('"{}"'.format(package_id) for package_id in chunk),
+                                               dataset_type)
+        result = toolkit.get_action('package_search')(context, {'fq': fq, 'rows': len(chunk)})
+        packages.update((package['id'], package) for package in result.get('results', []))
+
+    for package_id in package_ids:
+        if package_id not in packages:
+            packages[package_id] = toolkit.get_action('package_show')(context, {'id': package_id})
+    return packages
+
+
 @toolkit.side_effect_free
 def most_visited_packages(context, data_dict) -> Visits:
+    '''
+    Returns the most visited packages.
+
+    By default each package is returned as a full package_show dict.
+
+    :param fields: list or comma separated string of package columns to return
+        instead of full package dicts, from: id, name, title, title_translated,
+        owner_org, metadata_modified
+    :param batched: fetch the full package dicts with a single package_search
+        instead of a package_show per package
+    '''
 
     start_date = data_dict.get('start_date', None)
     end_date = data_dict.get('end_date', None)
     limit = data_dict.get('limit', None)
+    fields = data_dict.get('fields', None)
+    batched = toolkit.asbool(data_dict.get('batched', False))
 
     dataset_type = data_dict.get('type', 'dataset')
     if start_date:
         start_date = datetime.strptime(start_date, "%Y-%m-%d")
     if end_date:
         end_date = datetime.strptime(end_date, "%Y-%m-%d")
+    if fields is not None:
+        fields = _summary_fields(fields)
 
-    result = PackageStats.get_top(start_date=start_date,
-                            end_date=end_date,
-                            dataset_type=dataset_type,
-                            limit=limit)
-    packages = []
+    result = _get_top_packages(start_date=start_date,
+                               end_date=end_date,
+                               dataset_type=dataset_type,
+                               limit=limit)
+    top_packages = result.get('packages', [])
+    package_ids = [package.get('package_id') for package in top_packages]
+
+    if fields is not None:
+        summaries = PackageStats.get_package_summaries(package_ids)
+        package_dicts = {package_id: {field: summary[field] for field in fields}
+                         for package_id, summary in summaries.items()}
+    elif batched:
+        package_dicts = _search_packages_by_id(context, package_ids, dataset_type)
+    else:
+        package_dicts = {package_id: toolkit.get_action('package_show')(context, {'id': package_id})
+                         for package_id in package_ids}
 
-    for package in result.get('packages', []):
-        package_with_extras = toolkit.get_action('package_show')(context, {'id': package.get('package_id')})
+    packages = []
+    for package in top_packages:
+        package_with_extras = package_dicts.get(package.get('package_id'))
+        if package_with_extras is None:
+            continue
         package_with_extras['visits'] = package.get('visits', 0)
         package_with_extras['visit_date'] = package.get('visit_date')
         packages.append(package_with_extras)
     result['packages'] = sorted(packages, key=itemgetter('visits'), reverse=True)
     return result
+
+
+@toolkit.side_effect_free
+def matomo_tracking_stats(context, data_dict):
+    '''
+    Returns the tracking queue counters of the current process:
+    enqueued, sent, dropped and failed events and the current queue size.
+    '''
+    toolkit.check_access('matomo_tracking_stats', context, data_dict)
+    return get_tracking_dispatcher().stats()
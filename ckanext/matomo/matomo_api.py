@@ -1,18 +1,122 @@
 import requests
 import datetime
+import threading
 import uuid
 
-from typing import Dict, Any
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, Callable, NamedTuple, Optional
+from urllib.parse import urlencode
+from urllib3.util.retry import Retry
 
 log = __import__('logging').getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = 300
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session: Optional[requests.Session] = None
+_tracking_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def _mount(session: requests.Session, retry: Retry, pool_size: int) -> requests.Session:
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                   backoff_factor=DEFAULT_BACKOFF_FACTOR) -> requests.Session:
+    '''
+    Creates a pooled session for reporting API requests which keeps connections alive
+    and retries requests with backoff on connection errors, 429 and 5xx responses.
+    POST is retried as well, report requests including API.getBulkRequest only read data.
+    '''
+    retry = Retry(total=max_retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUS_CODES,
+                  allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'},
+                  raise_on_status=False)
+    return _mount(requests.Session(), retry, pool_size)
+
+
+def create_tracking_session(pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                            backoff_factor=DEFAULT_BACKOFF_FACTOR) -> requests.Session:
+    '''
+    Creates a pooled session for tracking requests which only retries failed connections.
+    Matomo may have recorded the hits before a read timeout or an error response,
+    so retrying those would count the events twice.
+    '''
+    retry = Retry(total=max_retries,
+                  read=0,
+                  status=0,
+                  backoff_factor=backoff_factor,
+                  allowed_methods=Retry.DEFAULT_ALLOWED_METHODS - {'POST'},
+                  respect_retry_after_header=False,
+                  raise_on_status=False)
+    return _mount(requests.Session(), retry, pool_size)
+
+
+def configure_session(**kwargs) -> requests.Session:
+    '''
+    Replaces the process-wide reporting and tracking sessions with ones created
+    with the given options, see create_session
+    '''
+    global _session, _tracking_session
+    with _session_lock:
+        previous = (_session, _tracking_session)
+        _session, _tracking_session = create_session(**kwargs), create_tracking_session(**kwargs)
+    for session in previous:
+        if session is not None:
+            session.close()
+    return _session
+
+
+def shared_session() -> requests.Session:
+    '''
+    Returns the process-wide reporting session shared by all MatomoAPI instances
+    '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def shared_tracking_session() -> requests.Session:
+    '''
+    Returns the process-wide tracking session shared by all MatomoAPI instances
+    '''
+    global _tracking_session
+    if _tracking_session is None:
+        with _session_lock:
+            if _tracking_session is None:
+                _tracking_session = create_tracking_session()
+    return _tracking_session
+
 class MatomoException(RuntimeError):
     pass
 
 
+class MatomoRequest(NamedTuple):
+    '''
+    Report request parameters and the handler used to process its result
+    '''
+    params: Dict[str, Any]
+    handler: Callable[[Any], Any]
+
+
 class MatomoAPI(object):
-    def __init__(self, matomo_url, id_site, token_auth):
+    def __init__(self, matomo_url, id_site, token_auth, session=None, timeout=DEFAULT_TIMEOUT,
+                 tracking_session=None):
         self.matomo_url = matomo_url
+        self.session = session or shared_session()
+        self.tracking_session = tracking_session or shared_tracking_session()
+        self.timeout = timeout
         self.tracking_url = '{}/matomo.php'.format(matomo_url)
         self.id_site = id_site
         self.token_auth = token_auth
@@ -30,24 +134,56 @@ class MatomoAPI(object):
 
         params = self.default_params.copy()
         params.update(extra_params)
-        result = requests.get(self.matomo_url, params=params).json()
+        result = self.session.get(self.matomo_url, params=params, timeout=self.timeout).json()
         if isinstance(result, dict) and result.get('result') == 'error':
             raise MatomoException(result.get('message'))
 
         return result
 
-    def resource_download_statistics(self, period='month', date='today', dataset=None) -> Dict[str, Any]:
+    def execute(self, request: MatomoRequest) -> Dict[str, Any]:
+        return _process_one_or_more_dates_result(self.get(request.params), request.handler)
+
+    def bulk(self, matomo_requests: Dict[str, MatomoRequest]) -> Dict[str, Any]:
+        '''
+        Executes multiple report requests with a single API.getBulkRequest call.
+
+        :param matomo_requests: {name: MatomoRequest}
+        :return: {name: processed result}, results have the same shape as from the single report methods
+        '''
+        if self.token_auth is None:
+            raise MatomoException('Matomo authentication token is not set!')
+        if not matomo_requests:
+            return {}
+
+        names = list(matomo_requests.keys())
+        params = {'module': 'API',
+                  'method': 'API.getBulkRequest',
+                  'format': 'JSON',
+                  'token_auth': self.token_auth}
+        for index, name in enumerate(names):
+            url_params = {'idSite': self.id_site, 'filter_limit': -1}
+            url_params.update(matomo_requests[name].params)
+            params['urls[{}]'.format(index)] = urlencode(url_params)
+
+        results = self.session.post(self.matomo_url, data=params, timeout=self.timeout).json()
+        if isinstance(results, dict) and results.get('result') == 'error':
+            raise MatomoException(results.get('message'))
+        if not isinstance(results, list) or len(results) != len(names):
+            raise MatomoException('Expected {} results from bulk request, got: {!r:.200}'.format(len(names), results))
+
+        processed: Dict[str, Any] = {}
+        for name, result in zip(names, results):
+            if isinstance(result, dict) and result.get('result') == 'error':
+                raise MatomoException('{}: {}'.format(name, result.get('message')))
+            processed[name] = _process_one_or_more_dates_result(result, matomo_requests[name].handler)
+
+        return processed
+
+    def resource_download_statistics_request(self, period='month', date='today', dataset=None) -> MatomoRequest:
         pattern = '/data/([^/]+/)?dataset/[^/]+/resource/[^/]+/download/[^/]+$'
         if dataset:
             pattern = '/data/([^/]+/)?dataset/{dataset}/resource/[^/]+/download/[^/]+$'.format(dataset=dataset)
 
-        data: Dict[str, Any] = self.get({'method': 'Actions.getDownloads',
-                         'period': period,
-                         'date': date,
-                         'flat': 1,
-                         'filter_column': 'label',
-                         'filter_pattern': pattern })
-
         def handle(data) -> Dict[str, Any]:
             result: Dict[str, Any] = {}
             for datum in data:
@@ -59,21 +195,22 @@ class MatomoAPI(object):
 
             return result
 
-        return _process_one_or_more_dates_result(data, handle)
+        return MatomoRequest({'method': 'Actions.getDownloads',
+                              'period': period,
+                              'date': date,
+                              'flat': 1,
+                              'filter_column': 'label',
+                              'filter_pattern': pattern}, handle)
 
-    def dataset_page_statistics(self, period='month', date='today', dataset=None) -> Dict[str, Any]:
+    def resource_download_statistics(self, period='month', date='today', dataset=None) -> Dict[str, Any]:
+        return self.execute(self.resource_download_statistics_request(period, date, dataset))
+
+    def dataset_page_statistics_request(self, period='month', date='today', dataset=None) -> MatomoRequest:
         # TODO: /data/ should be config based, fine for our projects for now
         pattern = '[^/]*/data/([^/]+/)?dataset/[^/]+$'
         if dataset:
             pattern = '[^/]*/data/([^/]+/)?dataset/{dataset}$'.format(dataset=dataset)
 
-        data: Dict[str, Any] = self.get({'method': 'Actions.getPageUrls',
-                         'period': period,
-                         'date': date,
-                         'flat': 1,
-                         'filter_column': 'label',
-                         'filter_pattern': pattern})
-
         def handle(data) -> Dict[str, Any]:
             result: Dict[str, Any] = {}
 
@@ -84,20 +221,21 @@ class MatomoAPI(object):
 
             return result
 
-        return _process_one_or_more_dates_result(data, handle)
+        return MatomoRequest({'method': 'Actions.getPageUrls',
+                              'period': period,
+                              'date': date,
+                              'flat': 1,
+                              'filter_column': 'label',
+                              'filter_pattern': pattern}, handle)
 
-    def resource_page_statistics(self, period='month', date='today', dataset=None) -> Dict[str, Any]:
+    def dataset_page_statistics(self, period='month', date='today', dataset=None) -> Dict[str, Any]:
+        return self.execute(self.dataset_page_statistics_request(period, date, dataset))
+
+    def resource_page_statistics_request(self, period='month', date='today', dataset=None) -> MatomoRequest:
         pattern = '[^/]*/data/([^/]+/)?dataset/[^/]+/resource/[^/]+$'
         if dataset:
             pattern = '[^/]*/data/([^/]+/)?dataset/{dataset}/resource/[^/]+$'.format(dataset=dataset)
 
-        data: Dict[str, Any] = self.get({'method': 'Actions.getPageUrls',
-                         'period': period,
-                         'date': date,
-                         'flat': 1,
-                         'filter_column': 'label',
-                         'filter_pattern': pattern})
-
         def handle(data) -> Dict[str, Any]:
             result: Dict[str, Any] = {}
 
@@ -108,47 +246,60 @@ class MatomoAPI(object):
 
             return result
 
-        return _process_one_or_more_dates_result(data, handle)
+        return MatomoRequest({'method': 'Actions.getPageUrls',
+                              'period': period,
+                              'date': date,
+                              'flat': 1,
+                              'filter_column': 'label',
+                              'filter_pattern': pattern}, handle)
 
-    def visits_by_country(self, period='month', date='today') -> Dict[str, Any]:
-        data: Dict[str, Any] = self.get({'method': 'UserCountry.getCountry',
-                         'period': period,
-                         'date': date,
-                         'flat': 1})
+    def resource_page_statistics(self, period='month', date='today', dataset=None) -> Dict[str, Any]:
+        return self.execute(self.resource_page_statistics_request(period, date, dataset))
 
+    def visits_by_country_request(self, period='month', date='today') -> MatomoRequest:
         def handle(data) -> Dict[str, Any]:
             return data
 
-        return _process_one_or_more_dates_result(data, handle)
+        return MatomoRequest({'method': 'UserCountry.getCountry',
+                              'period': period,
+                              'date': date,
+                              'flat': 1}, handle)
 
-    def search_terms(self, period='month', date='today') -> Dict[str, Any]:
-        data: Dict[str, Any] = self.get({'method': 'Actions.getSiteSearchKeywords',
-                         'period': period,
-                         'date': date,
-                         'flat': 1})
+    def visits_by_country(self, period='month', date='today') -> Dict[str, Any]:
+        return self.execute(self.visits_by_country_request(period, date))
 
+    def search_terms_request(self, period='month', date='today') -> MatomoRequest:
         def handle(data) -> Dict[str, Any]:
             return data
 
-        return _process_one_or_more_dates_result(data, handle)
+        return MatomoRequest({'method': 'Actions.getSiteSearchKeywords',
+                              'period': period,
+                              'date': date,
+                              'flat': 1}, handle)
 
-    def events(self, period='month', date='today', filter_column='Events_EventAction', filter_pattern=None) -> Dict[str, Any]:
+    def search_terms(self, period='month', date='today') -> Dict[str, Any]:
+        return self.execute(self.search_terms_request(period, date))
+
+    def events_request(self, period='month', date='today', filter_column='Events_EventAction',
+                       filter_pattern=None) -> MatomoRequest:
         filter = {
             'filter_column': filter_column,
         }
         if filter_pattern:
             filter['filter_pattern'] = filter_pattern
-        data: Dict[str, Any] = self.get({'method': 'Events.getAction',
-                         'period': period,
-                         'date': date,
-                         'flat': 1,
-                        'filter_limit': -1,
-                         **filter})
 
         def handle(data) -> Dict[str, Any]:
             return data
 
-        return _process_one_or_more_dates_result(data, handle)
+        return MatomoRequest({'method': 'Events.getAction',
+                              'period': period,
+                              'date': date,
+                              'flat': 1,
+                              'filter_limit': -1,
+                              **filter}, handle)
+
+    def events(self, period='month', date='today', filter_column='Events_EventAction', filter_pattern=None) -> Dict[str, Any]:
+        return self.execute(self.events_request(period, date, filter_column, filter_pattern))
 
     @classmethod
     def date_range(cls, start, end):
@@ -168,7 +319,26 @@ class MatomoAPI(object):
         if self.token_auth is not None:
             params['token_auth'] = self.token_auth
 
-        return requests.get(self.tracking_url, params=params, headers=extra_headers)
+        return self.tracking_session.get(self.tracking_url, params=params, headers=extra_headers, timeout=self.timeout)
+
+    def tracking_bulk(self, events):
+        '''
+        Sends multiple tracking events with a single bulk tracking request
+
+        :param events: list of tracking parameter dicts
+        '''
+        tracking_requests = []
+        for event in events:
+            params = self.tracking_params.copy()
+            params.update(event)
+            params['rand'] = str(uuid.uuid4())
+            tracking_requests.append('?' + urlencode(params))
+
+        data: Dict[str, Any] = {'requests': tracking_requests}
+        if self.token_auth is not None:
+            data['token_auth'] = self.token_auth
+
+        return self.tracking_session.post(self.tracking_url, json=data, timeout=self.timeout)
 
 
 def _process_one_or_more_dates_result(data, handler) -> Dict[str, Any]:
@@ -1,22 +1,28 @@
+import json
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Iterable, Sequence, Tuple, Any
 
-from sqlalchemy import types, func, Column, ForeignKey, not_, desc
-from sqlalchemy.orm import relationship
+from sqlalchemy import types, func, Column, ForeignKey, desc, tuple_, and_, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import relationship, aliased
 from sqlalchemy.ext.declarative import declarative_base
 
 import ckan.model as model
-from ckan.plugins.toolkit import get_action, ObjectNotFound, NotAuthorized
 
 from ckanext.matomo.utils import last_calendar_period
-from ckanext.matomo.types import Visit, Visits, VisitsByPackage, Resource, VisitsByResource
+from ckanext.matomo.types import Visit, Visits, VisitsByPackage, VisitsByResource, GroupedVisits
 
 import logging
 log = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Number of rows written per INSERT ... ON CONFLICT statement in bulk upserts
+UPSERT_CHUNK_SIZE = 1000
+ORGANIZATION_DATASET_SORT_COLUMNS = ('visits', 'entrances', 'downloads', 'events', 'package_name')
+ORGANIZATION_RESOURCE_SORT_COLUMNS = ('visits', 'downloads', 'events', 'resource_name', 'package_name')
+
 
 def sorting_direction(value, descending):
     if descending:
@@ -25,6 +31,55 @@ def sorting_direction(value, descending):
         return value
 
 
+def _bulk_upsert(cls, key_column, rows: Iterable[Sequence[Any]], fields: Sequence[str]) -> int:
+    '''
+    Writes stat rows of (item_id, visit_date, *field values) in chunks.
+    Existing rows for the same item_id/visit_date only get the given fields updated,
+    new rows get zero for the stat columns not in fields.
+    If the same item_id/visit_date is given multiple times, the last one wins.
+
+    Uses INSERT ... ON CONFLICT DO UPDATE on PostgreSQL and falls back to
+    a query and merge per chunk on other databases.
+
+    :return: number of distinct rows written
+    '''
+    stat_columns = [column.name for column in cls.__table__.columns
+                    if column.name not in (key_column.name, 'visit_date')]
+    values_by_key: Dict[Tuple[str, datetime], Dict[str, Any]] = {}
+    for row in rows:
+        item_id, visit_date = row[0], row[1]
+        values = values_by_key.setdefault((item_id, visit_date), {
+            key_column.name: item_id, 'visit_date': visit_date, **{column: 0 for column in stat_columns}})
+        values.update(zip(fields, row[2:]))
+
+    values_list = list(values_by_key.values())
+    is_postgresql = model.Session.get_bind().dialect.name == 'postgresql'
+
+    for index in range(0, len(values_list), UPSERT_CHUNK_SIZE):
+        chunk = values_list[index:index + UPSERT_CHUNK_SIZE]
+        if is_postgresql:
+            statement = pg_insert(cls.__table__).values(chunk)
+            statement = statement.on_conflict_do_update(
+                index_elements=[key_column.name, 'visit_date'],
+                set_={field: statement.excluded[field] for field in fields})
+            model.Session.execute(statement)
+        else:
+            keys = [(values[key_column.name], values['visit_date']) for values in chunk]
+            existing = {(getattr(stats, key_column.name), stats.visit_date): stats
+                        for stats in model.Session.query(cls).filter(tuple_(key_column, cls.visit_date).in_(keys))}
+            for values in chunk:
+                stats = existing.get((values[key_column.name], values['visit_date']))
+                if stats is None:
+                    model.Session.add(cls(**values))
+                else:
+                    for field in fields:
+                        setattr(stats, field, values[field])
+            model.Session.flush()
+
+    log.debug("Upserted %d %s rows", len(values_list), cls.__tablename__)
+    return len(values_list)
+
+
 class PackageStats(Base):
     """
     Contains stats for package (datasets)
@@ -71,7 +126,6 @@ class PackageStats(Base):
             package.downloads = downloads
             package.events = events
 
-        model.Session.commit()
         log.debug("Updated the number of visits, downloads and events for date: %s for package id: %s",
                   visit_date.strftime('%Y-%m-%d'), package_id)
         model.Session.flush()
@@ -144,6 +198,19 @@ class PackageStats(Base):
         model.Session.flush()
         return True
 
+    @classmethod
+    def bulk_upsert(cls, rows: Iterable[Sequence[Any]],
+                    fields: Sequence[str] = ('visits', 'entrances', 'downloads', 'events')) -> int:
+        '''
+        Creates or updates stats for multiple packages and dates at once.
+        Does not commit the session.
+
+        :param rows: iterable of (package_id, visit_date, *values for fields)
+        :param fields: stat columns given in rows, other columns of existing rows are left untouched
+        :return: number of rows written
+        '''
+        return _bulk_upsert(cls, cls.package_id, rows, fields)
+
     @classmethod
     def get_package_name_by_id(cls, package_id) -> str:
         package = model.Session.query(model.Package).filter(
@@ -154,59 +221,116 @@ class PackageStats(Base):
         return pack_name
 
     @classmethod
-    def get_total_visits(
-        cls,
-        start_date: Optional[datetime] = None,
-        end_date: Optional[datetime] = None,
-        descending: bool = True,
-        package_id: Optional[str] = None,
-        organization_id: Optional[str] = None
-    ) -> List[VisitsByPackage]:
+    def get_total_visits_by_organization(cls,
+                                         start_date: datetime,
+                                         end_date: datetime) -> GroupedVisits:
         '''
-        Returns datasets and their visitors amount summed during time span, grouped by dataset.
-
-        :param start_date: Optional[datetime] - time range filter start - default 2000-01-01
-        :param end_date: Optional[datetime] - time range filter end - default yesterday 23:59:59
-        :param descending: bool - sorting direction - default True for descending sorting
-        :param package_id: Optional[str] - package_id filtering
-        :param organization_id: Optional[str} - organization_id / owner_org filtering
-        :return: [{ package_id: str, owner_org: str, visits: int, entrances: int, downloads: int, events: int }, ...]
+        Returns visits of active public datasets summed during time span, grouped by organization.
+
+        :return: {owner_org: {visits: int, entrances: int, downloads: int, events: int}}
         '''
-        if not start_date:
-            start_date = datetime(2000, 1, 1, 0, 0, 0, 0)
-        if not end_date:
-            end_date = datetime.today() - relativedelta(days=1, hour=23, minute=59, second=59)
-
-        query = model.Session.query(
-            cls.package_id,
-            func.sum(cls.visits).label('total_visits'),
-            func.sum(cls.downloads).label('total_downloads'),
-            func.sum(cls.entrances).label('total_entrances'),
-            func.sum(cls.events).label('total_events')
-        ).filter(cls.visit_date >= start_date).filter(cls.visit_date <= end_date)
-        if package_id:
-            query = query.filter(cls.package_id == package_id)
-
-        if organization_id:
-            query = query.filter(model.Package.owner_org == organization_id)
-
-        visits_by_dataset = (query.join(model.Package, cls.package_id == model.Package.id)
-                             .filter(model.Package.state == 'active')
-                             .filter(model.Package.private == False)  # noqa: E712
-                             .group_by(cls.package_id)
-                             .order_by(sorting_direction('total_visits', descending))
-                             .all())
-
-        result: List[VisitsByPackage] = [{
-            "package_id": dataset.package_id,
-            "owner_org": cls.get_owner_org(dataset.package_id),
-            "visits": dataset.total_visits or 0,
-            "entrances": dataset.total_entrances or 0,
-            "downloads": dataset.total_downloads or 0,
-            "events": dataset.total_events or 0,
-        } for dataset in visits_by_dataset]
+        visits_by_organization = (model.Session.query(model.Package.owner_org,
+                                                      func.sum(cls.visits).label('visits'),
+                                                      func.sum(cls.entrances).label('entrances'),
+                                                      func.sum(cls.downloads).label('downloads'),
+                                                      func.sum(cls.events).label('events'))
+                                  .join(model.Package, cls.package_id == model.Package.id)
+                                  .filter(cls.visit_date >= start_date)
+                                  .filter(cls.visit_date <= end_date)
+                                  .filter(model.Package.owner_org.isnot(None))
+                                  .filter(model.Package.state == 'active')
+                                  .filter(model.Package.private == False)  # noqa: E712
+                                  .group_by(model.Package.owner_org)
+                                  .all())
+
+        return {organization.owner_org: {'visits': organization.visits or 0,
+                                         'entrances': organization.entrances or 0,
+                                         'downloads': organization.downloads or 0,
+                                         'events': organization.events or 0}
+                for organization in visits_by_organization}
 
-        return result
+    @classmethod
+    def get_organization_datasets(cls,
+                                  organization_id: str,
+                                  start_date: datetime,
+                                  end_date: datetime,
+                                  dataset_type: str = 'dataset',
+                                  sort_by: str = 'visits',
+                                  descending: bool = True,
+                                  limit: Optional[int] = None,
+                                  offset: int = 0) -> List[VisitsByPackage]:
+        '''
+        Returns active public datasets of the organization with their stats summed during time span,
+        datasets without stats have zero counts.
+
+        :param sort_by: one of ORGANIZATION_DATASET_SORT_COLUMNS
+        :param limit: Optional[int] - maximum number of datasets to return, default all
+        :param offset: int - number of datasets to skip
+        :return: [{package_id, package_name, package_title_translated, visits, entrances, downloads, events}]
+        '''
+        if sort_by not in ORGANIZATION_DATASET_SORT_COLUMNS:
+            raise ValueError('Unknown sort column: {}'.format(sort_by))
+
+        stats = (model.Session.query(cls.package_id,
+                                     func.sum(cls.visits).label('visits'),
+                                     func.sum(cls.entrances).label('entrances'),
+                                     func.sum(cls.downloads).label('downloads'),
+                                     func.sum(cls.events).label('events'))
+                 .join(model.Package, cls.package_id == model.Package.id)
+                 .filter(model.Package.owner_org == organization_id)
+                 .filter(cls.visit_date >= start_date)
+                 .filter(cls.visit_date <= end_date)
+                 .group_by(cls.package_id)
+                 .subquery())
+
+        sort_columns = {'visits': func.coalesce(stats.c.visits, 0),
+                        'entrances': func.coalesce(stats.c.entrances, 0),
+                        'downloads': func.coalesce(stats.c.downloads, 0),
+                        'events': func.coalesce(stats.c.events, 0),
+                        'package_name': model.Package.name}
+
+        title_translated = aliased(model.PackageExtra)
+        datasets = (model.Session.query(model.Package.id,
+                                        model.Package.name,
+                                        title_translated.value.label('title_translated'),
+                                        stats.c.visits,
+                                        stats.c.entrances,
+                                        stats.c.downloads,
+                                        stats.c.events)
+                    .outerjoin(stats, stats.c.package_id == model.Package.id)
+                    .outerjoin(title_translated, and_(title_translated.package_id == model.Package.id,
+                                                      title_translated.key == 'title_translated',
+                                                      title_translated.state == 'active'))
+                    .filter(model.Package.owner_org == organization_id)
+                    .filter(model.Package.type == dataset_type)
+                    .filter(model.Package.state == 'active')
+                    .filter(model.Package.private == False)  # noqa: E712
+                    .order_by(sorting_direction(sort_columns[sort_by], descending),
+                              model.Package.name, model.Package.id)
+                    .offset(offset)
+                    .limit(limit)
+                    .all())
+
+        return [{"package_id": dataset.id,
+                 "package_name": dataset.name,
+                 "package_title_translated": _load_json(dataset.title_translated),
+                 "visits": dataset.visits or 0,
+                 "entrances": dataset.entrances or 0,
+                 "downloads": dataset.downloads or 0,
+                 "events": dataset.events or 0}
+                for dataset in datasets]
+
+    @classmethod
+    def count_organization_datasets(cls, organization_id: str, dataset_type: str = 'dataset') -> int:
+        '''
+        Returns the number of datasets get_organization_datasets returns without a limit
+        '''
+        return (model.Session.query(func.count(model.Package.id))
+                .filter(model.Package.owner_org == organization_id)
+                .filter(model.Package.type == dataset_type)
+                .filter(model.Package.state == 'active')
+                .filter(model.Package.private == False)  # noqa: E712
+                .scalar())
 
     @classmethod
     def get_last_visits_by_id(cls, package_id, time='year') -> Visits:
@@ -238,88 +362,110 @@ class PackageStats(Base):
 
     @classmethod
     def get_top(cls, limit=20, start_date=None, end_date=None, dataset_type='dataset') -> Visits:
-        package_stats: List[PackageStats] = []
-        # TODO: Reimplement in more efficient manner if needed (using RANK OVER and PARTITION in raw sql)
-        unique_packages = (model.Session.query(cls.package_id,
-                                               func.sum(cls.visits),
-                                               func.sum(cls.entrances),
-                                               func.sum(cls.downloads))
-                           .filter(cls.package_id == model.Package.id)
-                           .filter(model.Package.state == 'active')
-                           .filter(model.Package.private == False)  # noqa: E712
-                           .filter(model.Package.type == dataset_type)
-                           .group_by(cls.package_id))
+        '''
+        Returns the most visited active public packages with their summed stats
+        and the date of their latest stats, using a single query.
+        '''
+        latest_stats = aliased(cls)
+        last_visit_date = (model.Session.query(func.max(latest_stats.visit_date))
+                           .filter(latest_stats.package_id == cls.package_id)
+                           .label('last_visit_date'))
+
+        query = (model.Session.query(cls.package_id,
+                                     model.Package.name,
+                                     model.Package.title,
+                                     func.sum(cls.visits).label('visits'),
+                                     func.sum(cls.entrances).label('entrances'),
+                                     func.sum(cls.downloads).label('downloads'),
+                                     func.sum(cls.events).label('events'),
+                                     last_visit_date)
+                 .join(model.Package, cls.package_id == model.Package.id)
+                 .filter(model.Package.state == 'active')
+                 .filter(model.Package.private == False)  # noqa: E712
+                 .filter(model.Package.type == dataset_type))
 
         if start_date:
-            unique_packages = unique_packages.filter(
-                cls.visit_date >= start_date)
+            query = query.filter(cls.visit_date >= start_date)
         if end_date:
-            unique_packages = unique_packages.filter(
-                cls.visit_date <= end_date)
+            query = query.filter(cls.visit_date <= end_date)
 
-        unique_packages = unique_packages.order_by(
-            func.count(cls.visits).desc()).limit(limit).all()
+        top_packages = (query.group_by(cls.package_id, model.Package.name, model.Package.title)
+                        .order_by(func.count(cls.visits).desc())
+                        .limit(limit)
+                        .all())
 
-        # Adding last date associated to this package stat and filtering out private and deleted packages
-        if unique_packages is not None:
-            for package in unique_packages:
-                package_id = package[0]
+        packages: List[VisitsByPackage] = [{
+            'package_name': package.title or package.name,
+            'package_id': package.package_id,
+            'visits': package.visits,
+            'entrances': package.entrances,
+            'downloads': package.downloads,
+            'events': package.events,
+            'visit_date': package.last_visit_date.strftime("%d-%m-%Y"),
+        } for package in top_packages]
 
-                tot_package = model.Session.query(model.Package).filter(model.Package.id == package_id).filter_by(
-                    state='active').filter_by(private=False).first()
-                if tot_package is None:
-                    continue
+        return {"packages": packages}
 
-                last_date = model.Session.query(func.max(cls.visit_date)).filter(
-                    cls.package_id == package_id).first()
+    @classmethod
+    def get_package_summaries(cls, package_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        '''
+        Returns basic package metadata for the given packages with a single query,
+        without dictizing the packages.
 
-                ps = PackageStats(package_id=package_id,
-                                  visit_date=last_date[0], visits=package[1], entrances=package[2], downloads=package[3])
-                package_stats.append(ps)
-        dictat = PackageStats.convert_to_dict(package_stats, None)
-        return dictat
+        :return: {package_id: {id, name, title, title_translated, owner_org, metadata_modified}}
+        '''
+        if not package_ids:
+            return {}
+
+        title_translated = aliased(model.PackageExtra)
+        rows = (model.Session.query(model.Package.id,
+                                    model.Package.name,
+                                    model.Package.title,
+                                    model.Package.owner_org,
+                                    model.Package.metadata_modified,
+                                    title_translated.value.label('title_translated'))
+                .outerjoin(title_translated, and_(title_translated.package_id == model.Package.id,
+                                                  title_translated.key == 'title_translated',
+                                                  title_translated.state == 'active'))
+                .filter(model.Package.id.in_(package_ids))
+                .all())
+
+        return {row.id: {
+            'id': row.id,
+            'name': row.name,
+            'title': row.title,
+            'title_translated': _load_json(row.title_translated),
+            'owner_org': row.owner_org,
+            'metadata_modified': row.metadata_modified.isoformat() if row.metadata_modified else None,
+        } for row in rows}
 
     @classmethod
     def get_all_visits(cls, dataset_id) -> Visits:
-        visits_dict: Visits = PackageStats.get_last_visits_by_id(
-            dataset_id, time='year')
-
-        visit_list: List[Dict[str, int]] = []
-        visits: List[VisitsByPackage] = visits_dict.get('packages', [])
-
-        # Creates a weekly grouped list for last year
-        current_end_of_week: datetime = get_end_of_last_week(datetime.now())
-        start_date: datetime = get_beginning_of_next_week(current_end_of_week.replace(hour=0,
-                                                                                      minute=0,
-                                                                                      second=0,
-                                                                                      microsecond=0)
-                                                          - timedelta(days=365))
-
-        while current_end_of_week > start_date:
-            current_start_of_week: datetime = get_beginning_of_week(
-                current_end_of_week)
-            weekly_download_count = 0
-            weekly_visit_count = 0
-            for visit in visits:
-                visit_date: datetime = datetime.strptime(
-                    visit.get('visit_date', ''), '%d-%m-%Y')
-                # Do nothing if date of visit isn't in period of current week
-                if visit_date < current_start_of_week or visit_date > current_end_of_week:
-                    continue
-                weekly_download_count += visit.get('downloads', 0)
-                weekly_visit_count += visit.get('visits', 0)
-
-            visit_list.append({'year': current_end_of_week.year, 'week': current_end_of_week.isocalendar()[1],
-                               'visits': weekly_visit_count, 'downloads': weekly_download_count})
-            current_end_of_week = current_end_of_week - timedelta(weeks=1)
-
-        # Revert visit list to make it end on previous week
-        visit_list = visit_list[::-1]
+        '''
+        Returns weekly visits and downloads of the package for the last year,
+        ending on the previous week, and its total visits and downloads.
+        '''
+        start_date, end_date = get_last_year_weeks(datetime.now())
+
+        week = func.date_trunc('week', cls.visit_date).label('week')
+        weekly_stats = (model.Session.query(week,
+                                            func.sum(cls.visits).label('visits'),
+                                            func.sum(cls.downloads).label('downloads'))
+                        .filter(cls.package_id == dataset_id,
+                                cls.visit_date >= start_date,
+                                cls.visit_date <= end_date)
+                        .group_by(week)
+                        .all())
+
+        totals = (model.Session.query(func.sum(cls.visits).label('visits'),
+                                      func.sum(cls.downloads).label('downloads'))
+                  .filter(cls.package_id == dataset_id)
+                  .first())
 
         results: Visits = {
-            "visits": visit_list,
-            "total_visits": visits_dict.get('total_visits', 0),
-            "total_downloads": visits_dict.get('total_downloads', 0)
+            "visits": weekly_buckets(start_date, end_date, weekly_stats, ('visits', 'downloads')),
+            "total_visits": totals.visits or 0,
+            "total_downloads": totals.downloads or 0
         }
         return results
 
@@ -358,15 +504,6 @@ class PackageStats(Base):
         else:
             return result.visit_date
 
-    @classmethod
-    def get_owner_org(cls, package_id) -> Optional[str]:
-        result = model.Session.query(model.Package.id, model.Package.owner_org).filter(
-            model.Package.id == package_id).first()
-        if result.owner_org:
-            return result.owner_org
-        else:
-            return None
-
 
 class ResourceStats(Base):
     """
@@ -406,7 +543,6 @@ class ResourceStats(Base):
             resource.visits = visits
             resource.visit_date = visit_date
 
-        model.Session.commit()
         log.debug("Updated the number of visits for resource id: %s", item_id)
         model.Session.flush()
         return True
@@ -431,7 +567,6 @@ class ResourceStats(Base):
             resource.downloads = downloads
             resource.visit_date = visit_date
 
-        model.Session.commit()
         log.debug("Updated the number of downloads for resource id: %s", item_id)
         model.Session.flush()
         return True
@@ -457,59 +592,52 @@ class ResourceStats(Base):
         return True
 
     @classmethod
-    def get_resource_info_by_id(cls, resource_id) -> Resource:
-        resource = get_action('resource_show')({}, {'id': resource_id})
-        package = get_action('package_show')({}, {'id': resource.get('package_id')})
-        result: Resource = {'resource_id': resource.get('id'), 'resource_name': resource.get('name'),
-                        'resource_name_translated': resource.get('name_translated'), 'package_id': package.get('id'),
-                        'package_name': package.get('name'), 'package_title': package.get('title'),
-                        'package_title_translated': package.get('title_translated'), 'owner_org': package.get('owner_org')}
-
-        return result
+    def bulk_upsert(cls, rows: Iterable[Sequence[Any]], fields: Sequence[str] = ('visits', 'downloads', 'events')) -> int:
+        '''
+        Creates or updates stats for multiple resources and dates at once.
+        Does not commit the session.
 
-    @classmethod
-    def get_all_visits_by_id(cls, resource_id) -> Visits:
-        resource_visits = model.Session.query(cls).filter(
-            cls.resource_id == resource_id).all()
-        total_visits = model.Session.query(func.sum(cls.visits)).filter(
-            cls.resource_id == resource_id).scalar()
-        total_downloads = model.Session.query(func.sum(cls.downloads)).filter(
-            cls.resource_id == resource_id).scalar()
-        visits: Visits = {}
-        if total_visits is not None or total_downloads is not None:
-            visits = ResourceStats.convert_to_dict(
-                resource_visits, total_visits, total_downloads)
-        return visits
+        :param rows: iterable of (resource_id, visit_date, *values for fields)
+        :param fields: stat columns given in rows, other columns of existing rows are left untouched
+        :return: number of rows written
+        '''
+        return _bulk_upsert(cls, cls.resource_id, rows, fields)
 
     @classmethod
     def get_downloads_in_date_range_by_id(cls, resource_id: str, start_date: datetime, end_date: datetime):
-        weekly_visits = ((model.Session.query(
-                                            func.date_trunc('week', cls.visit_date).label('weekly'),
-                                            func.sum(cls.downloads).label('weekly_downloads'))
-                         .filter(cls.resource_id == resource_id,
-                                 cls.visit_date >= start_date,
-                                 cls.visit_date <= end_date))
-                         .group_by('weekly').order_by('weekly').all())
-
+        weekly_downloads = cls.get_weekly_stats(resource_id, start_date, end_date)
+        totals = cls.get_totals(resource_id)
 
-        total_visits_and_downloads = (model.Session.query(func.sum(cls.visits).label('visits'),
-                                                         func.sum(cls.downloads).label('downloads'))
-                                      .filter(cls.resource_id == resource_id).first())
+        results = {'visits': weekly_buckets(start_date, end_date, weekly_downloads, ('downloads',)),
+                   'total_visits': totals.visits or 0,
+                   'total_downloads': totals.downloads or 0}
 
-        visits = [{'year': (start_date + timedelta(weeks=x)).year,
-                   'week': (start_date + timedelta(weeks=x)).isocalendar()[1],
-                   'downloads': 0} for x in range(0,52)]
-
-        for date in visits:
-            for week_visits in weekly_visits:
-                if date['year'] == week_visits.weekly.year and date['week'] == week_visits.weekly.isocalendar()[1]:
-                    date['downloads'] = week_visits.weekly_downloads
+        return results
 
-        results = {'visits': visits,
-                   'total_visits': total_visits_and_downloads.visits if total_visits_and_downloads.visits else 0,
-                   'total_downloads': total_visits_and_downloads.downloads if total_visits_and_downloads.downloads else 0}
+    @classmethod
+    def get_weekly_stats(cls, resource_id: str, start_date: datetime, end_date: datetime):
+        '''
+        Returns visits and downloads of the resource summed by week, see weekly_buckets
+        '''
+        week = func.date_trunc('week', cls.visit_date).label('week')
+        return (model.Session.query(week,
+                                    func.sum(cls.visits).label('visits'),
+                                    func.sum(cls.downloads).label('downloads'))
+                .filter(cls.resource_id == resource_id,
+                        cls.visit_date >= start_date,
+                        cls.visit_date <= end_date)
+                .group_by(week)
+                .all())
 
-        return results
+    @classmethod
+    def get_totals(cls, resource_id: str):
+        '''
+        Returns the total visits and downloads of the resource
+        '''
+        return (model.Session.query(func.sum(cls.visits).label('visits'),
+                                    func.sum(cls.downloads).label('downloads'))
+                .filter(cls.resource_id == resource_id)
+                .first())
 
     @classmethod
     def get_stat_counts_by_id_and_date_range(cls, resource_id: str,
@@ -540,141 +668,185 @@ class ResourceStats(Base):
         return {'visits': total_visits or 0, 'downloads': total_downloads or 0}
 
     @classmethod
-    def get_top(cls, limit=20):
-        resource_stats = []
-        # TODO: Reimplement in more efficient manner if needed (using RANK OVER and PARTITION in raw sql)
-        unique_resources = model.Session.query(cls.resource_id, func.count(cls.visits), func.sum(cls.downloads)).group_by(
-            cls.resource_id).order_by(func.sum(cls.downloads).desc()).having(func.sum(cls.downloads) > 0).join(
-                model.Resource, model.Resource.id == cls.resource_id).limit(limit).all()
-        # Adding last date associated to this package stat and filtering out private and deleted packages
-        if unique_resources is not None:
-            for resource in unique_resources:
-                resource_id = resource[0]
-                visits = resource[1]
-                downloads = resource[2]
-                # TODO: Check if associated resource is private
-                resource = model.Session.query(model.Resource).filter(model.Resource.id == resource_id).filter_by(
-                    state='active').first()
-                if resource is None:
-                    continue
-
-                last_date = model.Session.query(func.max(cls.visit_date)).filter(
-                    cls.resource_id == resource_id).first()
-
-                rs = ResourceStats(
-                    resource_id=resource_id, visit_date=last_date[0], visits=visits, downloads=downloads)
-                resource_stats.append(rs)
-        dictat = ResourceStats.convert_to_dict(resource_stats, None, None)
-        return dictat
+    def get_top(cls, limit=20) -> Visits:
+        '''
+        Returns the most downloaded active resources of active public packages with
+        the number of days with stats as visits and the date of their latest stats
+        '''
+        stats = (model.Session.query(cls.resource_id,
+                                     func.count(cls.visits).label('visits'),
+                                     func.sum(cls.downloads).label('downloads'),
+                                     func.sum(cls.events).label('events'),
+                                     func.max(cls.visit_date).label('last_visit'))
+                 .group_by(cls.resource_id)
+                 .having(func.sum(cls.downloads) > 0)
+                 .subquery())
+
+        top_resources = (cls._query_with_resource_metadata(stats)
+                         .order_by(stats.c.downloads.desc())
+                         .limit(limit)
+                         .all())
+
+        return {"resources": [cls._resource_stats_as_dict(resource) for resource in top_resources]}
 
     @classmethod
-    def get_total_downloads(cls,
-                            start_date: Optional[datetime] = None,
-                            end_date: Optional[datetime] = None,
-                            descending: bool = True,
-                            organization_id: Optional[str] = None) -> List[VisitsByResource]:
+    def get_organization_resources(cls,
+                                   organization_id: str,
+                                   start_date: datetime,
+                                   end_date: datetime,
+                                   dataset_type: str = 'dataset',
+                                   sort_by: str = 'downloads',
+                                   descending: bool = True,
+                                   limit: Optional[int] = None,
+                                   offset: int = 0) -> List[VisitsByResource]:
         '''
-        Returns resources and their download amount summed during time span, grouped by resource.
+        Returns active resources of the organization's active public datasets with their stats
+        summed during time span, resources without stats have zero counts.
 
-        :param start_date: Optional[datetime] - time range filter start - default 2000-01-01
-        :param end_date: Optional[datetime] - time range filter end - default yesterday 23:59:59
-        :param descending: bool - sorting direction - default True for descending sorting
-        :param organization_id: Optional[str} - organization_id / owner_org filtering
-        :return: [{'resource_id': str, 'package_id': str, 'visits': int, 'downloads': int, 'visit_date': str}, ...]
+        :param sort_by: one of ORGANIZATION_RESOURCE_SORT_COLUMNS
+        :param limit: Optional[int] - maximum number of resources to return, default all
+        :param offset: int - number of resources to skip
         '''
+        if sort_by not in ORGANIZATION_RESOURCE_SORT_COLUMNS:
+            raise ValueError('Unknown sort column: {}'.format(sort_by))
+
+        stats = (model.Session.query(cls.resource_id,
+                                     func.sum(cls.visits).label('visits'),
+                                     func.sum(cls.downloads).label('downloads'),
+                                     func.sum(cls.events).label('events'),
+                                     func.max(cls.visit_date).label('last_visit'))
+                 .join(model.Resource, model.Resource.id == cls.resource_id)
+                 .join(model.Package, model.Package.id == model.Resource.package_id)
+                 .filter(model.Package.owner_org == organization_id)
+                 .filter(cls.visit_date >= start_date)
+                 .filter(cls.visit_date <= end_date)
+                 .group_by(cls.resource_id)
+                 .subquery())
+
+        sort_columns = {'visits': func.coalesce(stats.c.visits, 0),
+                        'downloads': func.coalesce(stats.c.downloads, 0),
+                        'events': func.coalesce(stats.c.events, 0),
+                        'resource_name': model.Resource.name,
+                        'package_name': model.Package.name}
+
+        title_translated = aliased(model.PackageExtra)
+        resources = (model.Session.query(model.Resource.id.label('resource_id'),
+                                         model.Resource.name.label('resource_name'),
+                                         model.Resource.extras.label('resource_extras'),
+                                         model.Package.id.label('package_id'),
+                                         model.Package.name.label('package_name'),
+                                         model.Package.title.label('package_title'),
+                                         model.Package.owner_org,
+                                         title_translated.value.label('package_title_translated'),
+                                         stats.c.visits,
+                                         stats.c.downloads,
+                                         stats.c.events,
+                                         stats.c.last_visit)
+                     .join(model.Package, model.Package.id == model.Resource.package_id)
+                     .outerjoin(stats, stats.c.resource_id == model.Resource.id)
+                     .outerjoin(title_translated, and_(title_translated.package_id == model.Package.id,
+                                                       title_translated.key == 'title_translated',
+                                                       title_translated.state == 'active'))
+                     .filter(model.Package.owner_org == organization_id)
+                     .filter(model.Package.type == dataset_type)
+                     .filter(model.Package.state == 'active')
+                     .filter(model.Package.private == False)  # noqa: E712
+                     .filter(model.Resource.state == 'active')
+                     .order_by(sorting_direction(sort_columns[sort_by], descending),
+                               model.Package.name, model.Resource.position, model.Resource.id)
+                     .offset(offset)
+                     .limit(limit)
+                     .all())
+
+        return [cls._resource_stats_as_dict(resource) for resource in resources]
 
-        if not start_date:
-            start_date = datetime(2000, 1, 1, 0, 0, 0, 0)
-        if not end_date:
-            end_date = datetime.today() - relativedelta(days=1, hour=23, minute=59, second=59)
-
-        query = model.Session.query(
-            model.Resource.id,
-            model.Resource.package_id,
-            func.sum(cls.visits).label('visits'),
-            func.sum(cls.downloads).label('downloads'),
-            func.sum(cls.events).label('events'),
-            func.max(cls.visit_date).label('last_visit')
-        ).filter(cls.visit_date >= start_date).filter(cls.visit_date <= end_date)
-
-        visits_by_resource = (query.join(model.Resource, model.Resource.id == cls.resource_id)
-                              .group_by(model.Resource.id)
-                              .order_by(sorting_direction('downloads', descending))).all()
-
-        if organization_id:
-            organizations_packages_query = (model.Session.query(model.Package.id, model.Package.owner_org)
+    @classmethod
+    def count_organization_resources(cls, organization_id: str, dataset_type: str = 'dataset') -> int:
+        '''
+        Returns the number of resources get_organization_resources returns without a limit
+        '''
+        return (model.Session.query(func.count(model.Resource.id))
+                .join(model.Package, model.Package.id == model.Resource.package_id)
                 .filter(model.Package.owner_org == organization_id)
+                .filter(model.Package.type == dataset_type)
                 .filter(model.Package.state == 'active')
                 .filter(model.Package.private == False)  # noqa: E712
-                .group_by(model.Package.id).all())
-            org_packages = [
-                package.id for package in organizations_packages_query]
-            visits_by_resource: List[ResourceStats] = [
-                visit for visit in visits_by_resource if visit.package_id in org_packages]
-
-        resource_stats: List[ResourceStats] = []
-
-        for resource in visits_by_resource:
-            rs = ResourceStats(resource_id=resource.id,
-                               visit_date=resource.last_visit,
-                               visits=resource.visits or 0,
-                               downloads=resource.downloads or 0,
-                               events=resource.events or 0)
-            resource_stats.append(rs)
-        dictat: Visits = ResourceStats.convert_to_dict(
-            resource_stats, None, None)
-
-        return sorted(dictat.get(
-            'resources', []), key=lambda resource: resource.get('downloads', 0), reverse=True)
+                .filter(model.Resource.state == 'active')
+                .scalar())
 
     @classmethod
-    def as_dict(cls, res) -> Optional[VisitsByResource]:
-        result: VisitsByResource = {}
-        try:
-            res_info = ResourceStats.get_resource_info_by_id(
-                res.resource_id)
-            result['resource_id'] = res_info['resource_id']
-            result['resource_name'] = res_info['resource_name']
-            result['resource_name_translated'] = res_info['resource_name_translated']
-            result['package_id'] = res_info['package_id']
-            result['package_name'] = res_info['package_name']
-            result['package_title'] = res_info['package_title']
-            result['package_title_translated'] = res_info['package_title_translated']
-            result['owner_org'] = res_info['owner_org']
-            result['visits'] = res.visits
-            result['downloads'] = res.downloads
-            result['events'] = res.events
-            result['visit_date'] = res.visit_date.strftime(
-                "%d-%m-%Y") if res.visit_date else ''
-            return result
-
-        except NotAuthorized:
-            print('No access to private resource "{}", skipping...'.format(res.resource_id))
-            return None
+    def _query_with_resource_metadata(cls, stats):
+        '''
+        Returns a query of the aggregated stats joined with the metadata of their resources and packages,
+        leaving out stats of deleted resources and deleted or private packages
 
-        except ObjectNotFound:
-            print('Resource "{}" not found, skipping...'.format(res.resource_id))
-            return None
+        :param stats: subquery with resource_id, visits, downloads, events and last_visit columns
+        '''
+        title_translated = aliased(model.PackageExtra)
+        return (model.Session.query(stats,
+                                    model.Resource.name.label('resource_name'),
+                                    model.Resource.extras.label('resource_extras'),
+                                    model.Package.id.label('package_id'),
+                                    model.Package.name.label('package_name'),
+                                    model.Package.title.label('package_title'),
+                                    model.Package.owner_org,
+                                    title_translated.value.label('package_title_translated'))
+                .join(model.Resource, model.Resource.id == stats.c.resource_id)
+                .join(model.Package, model.Package.id == model.Resource.package_id)
+                .outerjoin(title_translated, and_(title_translated.package_id == model.Package.id,
+                                                  title_translated.key == 'title_translated',
+                                                  title_translated.state == 'active'))
+                .filter(model.Resource.state == 'active')
+                .filter(model.Package.state == 'active')
+                .filter(model.Package.private == False))  # noqa: E712
 
     @classmethod
-    def convert_to_dict(cls, resource_stats, total_visits=None, total_downloads=None) -> Visits:
-        visits: List[VisitsByResource] = []
-
-        for resource in resource_stats:
-            result = ResourceStats.as_dict(resource)
-            if result:
-                visits.append(result)
-
-        results: Visits = {
-            "resources": visits
+    def _resource_stats_as_dict(cls, row) -> VisitsByResource:
+        resource_extras = row.resource_extras or {}
+        return {
+            'resource_id': row.resource_id,
+            'resource_name': row.resource_name,
+            'resource_name_translated': _load_json(resource_extras.get('name_translated')),
+            'package_id': row.package_id,
+            'package_name': row.package_name,
+            'package_title': row.package_title,
+            'package_title_translated': _load_json(row.package_title_translated),
+            'owner_org': row.owner_org,
+            'visits': row.visits or 0,
+            'downloads': row.downloads or 0,
+            'events': row.events or 0,
+            'visit_date': row.last_visit.strftime("%d-%m-%Y") if row.last_visit else '',
         }
-        if total_visits is not None:
-            results['total_visits'] = total_visits
 
-        if total_downloads is not None:
-            results['total_downloads'] = total_downloads
+    @classmethod
+    def get_total_downloads_by_organization(cls,
+                                            start_date: datetime,
+                                            end_date: datetime) -> GroupedVisits:
+        '''
+        Returns visits and downloads of active resources of active public datasets
+        summed during time span, grouped by organization.
 
-        return results
+        :return: {owner_org: {visits: int, downloads: int, events: int}}
+        '''
+        visits_by_organization = (model.Session.query(model.Package.owner_org,
+                                                      func.sum(cls.visits).label('visits'),
+                                                      func.sum(cls.downloads).label('downloads'),
+                                                      func.sum(cls.events).label('events'))
+                                  .join(model.Resource, model.Resource.id == cls.resource_id)
+                                  .join(model.Package, model.Package.id == model.Resource.package_id)
+                                  .filter(cls.visit_date >= start_date)
+                                  .filter(cls.visit_date <= end_date)
+                                  .filter(model.Package.owner_org.isnot(None))
+                                  .filter(model.Resource.state == 'active')
+                                  .filter(model.Package.state == 'active')
+                                  .filter(model.Package.private == False)  # noqa: E712
+                                  .group_by(model.Package.owner_org)
+                                  .all())
+
+        return {organization.owner_org: {'visits': organization.visits or 0,
+                                         'downloads': organization.downloads or 0,
+                                         'events': organization.events or 0}
+                for organization in visits_by_organization}
 
     @classmethod
     def get_download_count_for_dataset(cls, package_id: str, start_date: datetime, end_date: datetime) -> int:
@@ -688,44 +860,18 @@ class ResourceStats(Base):
 
     @classmethod
     def get_all_visits(cls, id) -> Visits:
-        visits_dict = ResourceStats.get_all_visits_by_id(id)
-        total_downloads = visits_dict.get('total_downloads', 0)
-        total_visits = visits_dict.get('total_visits', 0)
-        visits = visits_dict.get('resources', [])
-        visit_list = []
-
-        # Creates a weekly grouped list for last year
-        current_end_of_week = get_end_of_last_week(datetime.now())
-        start_date = get_beginning_of_next_week(current_end_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
-                                                - timedelta(days=365))
-
-        while current_end_of_week > start_date:
-            current_start_of_week = get_beginning_of_week(current_end_of_week)
-            weekly_download_count = 0
-            weekly_visit_count = 0
-            for visit in visits:
-                visit_date = datetime.strptime(
-                    visit.get('visit_date', ''), '%d-%m-%Y')
-                # Do nothing if date of visit isn't in period of current week
-                if visit_date < current_start_of_week or visit_date > current_end_of_week:
-                    continue
-
-                if visit.get('downloads', 0) is not None:
-                    weekly_download_count += visit.get('downloads', 0)
-                if visit.get('visits', 0) is not None:
-                    weekly_visit_count += visit.get('visits', 0)
-
-            visit_list.append({'year': current_end_of_week.year, 'week': current_end_of_week.isocalendar()[1],
-                               'visits': weekly_visit_count, 'downloads': weekly_download_count})
-            current_end_of_week = current_end_of_week - timedelta(weeks=1)
-
-        # Revert visit list to make it end on previous week
-        visit_list = visit_list[::-1]
+        '''
+        Returns weekly visits and downloads of the resource for the last year,
+        ending on the previous week, and its total visits and downloads.
+        '''
+        start_date, end_date = get_last_year_weeks(datetime.now())
+        weekly_stats = cls.get_weekly_stats(id, start_date, end_date)
+        totals = cls.get_totals(id)
 
         results: Visits = {
-            "visits": visit_list,
-            "total_downloads": total_downloads,
-            "total_visits": total_visits,
+            "visits": weekly_buckets(start_date, end_date, weekly_stats, ('visits', 'downloads')),
+            "total_downloads": totals.downloads or 0,
+            "total_visits": totals.visits or 0,
         }
         return results
 
@@ -809,7 +955,7 @@ class AudienceLocationDate(Base):
         if location is None:
             location = AudienceLocation(location_name=location_name)
             model.Session.add(location)
-            model.Session.commit()
+            model.Session.flush()
 
         # find if location already has views for that date
         location_by_date = model.Session.query(cls).filter(cls.location_id == location.id).filter(
@@ -827,188 +973,92 @@ class AudienceLocationDate(Base):
         return True
 
     @classmethod
-    def get_visits(cls, start_date, end_date):
-        '''
-        Get all visits items between selected dates
-        grouped by date
-
-        returns list of dicst like:
-        [
-            {
-                location_name
-                date
-                visits
-            }
-        ]
-        '''
-        data = model.Session.query(cls.visits, cls.date, cls.location_id) \
+    def special_total_by_months(cls, start_date=None, end_date=None):
+        if end_date is None:
+            # last day of last month
+            end_date = datetime.today().replace(day=1) - timedelta(days=1)
+        if start_date is None:
+            start_date = end_date - timedelta(days=365)  # one year
+
+        month = func.date_trunc('month', cls.date).label('month')
+        months = model.Session.query(month,
+                                     func.max(cls.date).label('date'),
+                                     func.sum(cls.visits).label('visits')) \
             .filter(cls.date >= start_date) \
             .filter(cls.date <= end_date) \
-            .order_by(cls.date.desc()) \
+            .group_by(month) \
+            .order_by(month) \
             .all()
 
-        return cls.convert_list_to_dicts(data)
+        return [{'combined_date': '{}-{}'.format(row.month.month, row.month.year),
+                 'date': str(row.date),
+                 'visits': row.visits or 0}
+                for row in months]
 
     @classmethod
-    def get_first_date(cls, start_date=None, end_date=None):
-        query = model.Session.query(func.min(cls.date))
-        if start_date is not None:
-            query = query.filter(cls.date >= start_date)
-        if end_date is not None:
-            query = query.filter(cls.date <= end_date)
-        result = query.one_or_none()
-        return result[0] if result is not None else None
-
-    @classmethod
-    def get_total_visits(cls, start_date=None, end_date=None):
+    def get_location_summary(cls, periods: Dict[str, Tuple[datetime, datetime]]) -> List[Dict[str, Any]]:
         '''
-        Returns the total amount of visits on the website
-        from the start date to the end date
+        Returns the visits of every location in total and within each of the given periods
+        using a single query, sorted by total visits. Visits without a location are
+        summed in a row whose location_name is None.
 
-        return dict like:
-        {
-            total_visits
-        }
+        :param periods: {period name: (start_date, end_date)}
+        :return: [{location_name, total_visits, first_date, <period name>: visits}]
         '''
-        total_visits = model.Session.query(func.sum(cls.visits))
-
-        if start_date is not None:
-            total_visits = total_visits.filter(cls.date >= start_date)
-        if end_date is not None:
-            total_visits = total_visits.filter(cls.date <= end_date)
+        columns = [AudienceLocation.location_name,
+                   func.sum(cls.visits).label('total_visits'),
+                   func.min(cls.date).label('first_date')]
+        for name, (start_date, end_date) in periods.items():
+            in_period = and_(cls.date >= start_date, cls.date <= end_date)
+            columns.append(func.sum(case((in_period, cls.visits), else_=0)).label(name))
+
+        locations = model.Session.query(*columns) \
+            .outerjoin(AudienceLocation, AudienceLocation.id == cls.location_id) \
+            .group_by(cls.location_id, AudienceLocation.location_name) \
+            .order_by(func.sum(cls.visits).desc()) \
+            .all()
 
-        return {"total_visits": total_visits.scalar()}
+        summary = []
+        for location in locations:
+            location_summary = location._asdict()
+            for name in ('total_visits', *periods):
+                location_summary[name] = location_summary[name] or 0
+            summary.append(location_summary)
+        return summary
 
     @classmethod
-    def get_total_visits_by_location(cls, start_date, end_date, location_name):
+    def get_monthly_summary(cls, periods: Dict[str, Tuple[datetime, datetime]]) -> Dict[str, List[Dict[str, Any]]]:
         '''
-        Returns amount of visits in the location
-        from start_date to end_date
-
-        ! in the beginning of location_name works as NOT
+        Returns the total visits by month within each of the given periods using a single query
 
-        !Finland = not Finland
-        returns everything that is not Finland
-
-        returns list of dicst like:
-        [
-            {
-                location_name
-                total_visits
-            }
-        ]
+        :param periods: {period name: (start_date, end_date)}
+        :return: {period name: [{combined_date, date, visits}]} like special_total_by_months
         '''
-
-        negate = False
-        if location_name.startswith('!'):
-            location_name = location_name[1:]
-            negate = True
-
-        location_id = cls.get_location_id_by_name(location_name)
-        if location_id:
-            total_visits = model.Session.query(func.sum(cls.visits))\
-                .filter(maybe_negate(cls.location_id, location_id, negate)) \
-                .filter(cls.date >= start_date) \
-                .filter(cls.date <= end_date) \
-                .scalar()
-        else:
-            total_visits = 0
-
-        return {"total_visits": total_visits}
-
-    @classmethod
-    def get_total_top_locations(cls, limit=20):
-        '''
-        Locations sorted by total visits
-
-        returns list of dicts like:
-        [
-            {
-                location_name
-                total_visits
-            }
-        ]
-        '''
-        locations = model.Session.query(cls.location_id, func.sum(cls.visits).label('total_visits')) \
-            .group_by(cls.location_id) \
-            .order_by(func.sum(cls.visits).desc()) \
-            .limit(limit) \
+        if not periods:
+            return {}
+
+        month = func.date_trunc('month', cls.date).label('month')
+        columns = [month]
+        for start_date, end_date in periods.values():
+            in_period = and_(cls.date >= start_date, cls.date <= end_date)
+            columns.append(func.max(case((in_period, cls.date))))
+            columns.append(func.sum(case((in_period, cls.visits))))
+
+        months = model.Session.query(*columns) \
+            .filter(cls.date >= min(start_date for start_date, _end_date in periods.values())) \
+            .filter(cls.date <= max(end_date for _start_date, end_date in periods.values())) \
+            .group_by(month) \
+            .order_by(month) \
             .all()
 
-        result = cls.convert_list_to_dicts(locations)
-        all_visits = AudienceLocationDate.get_total_visits().get('total_visits', 0) or 0
-        result.append({
-            'location_name': 'Other',
-            'total_visits': all_visits - sum(x.get('total_visits', 0) for x in result)
-        })
-
-        for r in result:
-            if all_visits != 0:
-                r['percent_visits'] = 100.0 * \
-                    r.get('total_visits', 0.0) / all_visits
-            else:
-                r['percent_visits'] = 0.0
-
-        return result
-
-    @classmethod
-    def special_total_location_to_rest(cls, start_date, end_date, location):
-        location_details = cls.get_total_visits_by_location(
-            start_date, end_date, location)
-        location_details['location_name'] = location
-        rest = cls.get_total_visits_by_location(
-            start_date, end_date, '!' + location)
-        rest['location_name'] = 'Other'
-
-        return [
-            location_details,
-            rest,
-        ]
-
-    @classmethod
-    def special_total_by_months(cls, start_date=None, end_date=None):
-        if end_date is None:
-            # last day of last month
-            end_date = datetime.today().replace(day=1) - timedelta(days=1)
-        if start_date is None:
-            start_date = end_date - timedelta(days=365)  # one year
-
-        visits = cls.get_visits(start_date=start_date, end_date=end_date)
-
-        unique_months = []
-        results = []
-
-        for item in visits:
-            combined_date = str(item['date'].month) + \
-                '-' + str(item['date'].year)
-            if combined_date in unique_months:
-                for x in results:
-                    if x['combined_date'] == combined_date:
-                        x['visits'] += item['visits']
-            else:
-                unique_months.append(combined_date)
-                results.append({'combined_date': combined_date, 'date': item['date'].__str__(
-                ), 'visits': item['visits']})
-
-        results.sort(key=lambda x: x['date'])
-
+        results: Dict[str, List[Dict[str, Any]]] = {}
+        for index, name in enumerate(periods):
+            results[name] = [{'combined_date': '{}-{}'.format(row[0].month, row[0].year),
+                              'date': str(row[1 + 2 * index]),
+                              'visits': row[2 + 2 * index] or 0}
+                             for row in months if row[1 + 2 * index] is not None]
         return results
 
-    @classmethod
-    def get_location_name_by_id(cls, location_id):
-        location = model.Session.query(AudienceLocation).filter(
-            AudienceLocation.id == location_id).first()
-        return location.location_name
-
-    @classmethod
-    def get_location_id_by_name(cls, location_name):
-        location = model.Session.query(AudienceLocation).filter(
-            AudienceLocation.location_name == location_name).first()
-        location_id = []
-        if location is not None:
-            location_id = location.id
-        return location_id
-
     @classmethod
     def get_latest_update_date(cls):
         result = model.Session.query(cls).order_by(cls.date.desc()).first()
@@ -1017,29 +1067,6 @@ class AudienceLocationDate(Base):
         else:
             return result.date
 
-    @classmethod
-    def as_dict(cls, location):
-        result = {}
-        tmp_dict = location._asdict()
-        location_name = cls.get_location_name_by_id(tmp_dict['location_id'])
-        if location_name:
-            result['location_name'] = location_name
-        if 'date' in tmp_dict:
-            result['date'] = tmp_dict['date']
-        if 'visits' in tmp_dict:
-            result['visits'] = tmp_dict['visits']
-        if 'total_visits' in tmp_dict:
-            result['total_visits'] = tmp_dict['total_visits']
-        return result
-
-    @classmethod
-    def convert_list_to_dicts(cls, location_stats):
-        visits = []
-        for location in location_stats:
-            visits.append(AudienceLocationDate.as_dict(location))
-
-        return visits
-
 
 class SearchStats(Base):
     """
@@ -1081,41 +1108,45 @@ class SearchStats(Base):
                 search_term=search_term, date=date, count=count))
         else:
             row.count = count
-        model.Session.commit()
         model.Session.flush()
         return True
 
     @classmethod
-    def get_most_popular_search_terms(cls, start_date, end_date, limit=50):
-        results = model.Session.query(cls).filter(
-            cls.date >= start_date).filter(cls.date <= end_date).all()
-        search_term_counts = {}
-        for result in results:
-            if result.search_term in search_term_counts:
-                search_term_counts[result.search_term]['count'] += result.count
-                if result.date > search_term_counts[result.search_term]['date']:
-                    search_term_counts[result.search_term]['date'] = result.date
-            else:
-                search_term_counts[result.search_term] = {
-                    'count': result.count}
-                search_term_counts[result.search_term]['date'] = result.date
-
-        search_term_list = []
-        for search_term, search_term_info in search_term_counts.items():
-            search_term_list.append(
-                {"search_term": search_term,
-                 "count": search_term_info['count'],
-                 "latest_search_date": search_term_info['date'].strftime('%Y-%m-%d')
-                 }
-            )
-
-        return sorted(search_term_list, key=lambda search_term: search_term["count"], reverse=True)[:limit]
-
-
-def maybe_negate(value, inputvalue, negate=False):
-    if negate:
-        return not_(value == inputvalue)
-    return (value == inputvalue)
+    def get_most_popular_search_terms(cls, start_date, end_date, limit=50, normalize=False):
+        '''
+        Returns the most searched search terms within the date range
+
+        :param limit: maximum number of search terms to return
+        :param normalize: count search terms case insensitively and ignoring surrounding whitespace,
+            the normalized search terms are returned
+        :return: [{search_term: str, count: int, latest_search_date: str}]
+        '''
+        search_term = func.lower(func.trim(cls.search_term)) if normalize else cls.search_term
+        search_term = search_term.label('search_term')
+        total_count = func.sum(cls.count).label('count')
+
+        results = (model.Session.query(search_term,
+                                       total_count,
+                                       func.max(cls.date).label('latest_search_date'))
+                   .filter(cls.date >= start_date, cls.date <= end_date)
+                   .group_by(search_term)
+                   .order_by(total_count.desc(), search_term)
+                   .limit(limit)
+                   .all())
+
+        return [{"search_term": result.search_term,
+                 "count": result.count or 0,
+                 "latest_search_date": result.latest_search_date.strftime('%Y-%m-%d')}
+                for result in results]
+
+
+def _load_json(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
 
 
 def init_tables(engine):
@@ -1145,3 +1176,37 @@ def get_end_of_last_week(date: datetime) -> datetime:
     date = get_end_of_week(date)
     date = date - timedelta(weeks=1)
     return date
+
+
+def get_last_year_weeks(date: datetime) -> Tuple[datetime, datetime]:
+    '''
+    Returns the beginning and the end of the whole weeks of the year ending on the week before the given date
+    '''
+    end_date = get_end_of_last_week(date)
+    start_date = get_beginning_of_next_week(end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+                                            - timedelta(days=365))
+    return start_date, end_date
+
+
+def weekly_buckets(start_date: datetime, end_date: datetime, weekly_stats, fields: Sequence[str]) -> List[Dict[str, int]]:
+    '''
+    Returns stats for every week between the given dates, oldest first, with zeros for weeks without stats
+
+    :param weekly_stats: rows with the beginning of the week as the first column and the stats as attributes
+    :param fields: names of the stats attributes to include
+    :return: [{year: int, week: int, <field>: int}], year and ISO week number of the end of each week
+    '''
+    stats_by_week = {row[0].date(): row for row in weekly_stats}
+
+    buckets: List[Dict[str, int]] = []
+    beginning_of_week = get_beginning_of_week(start_date)
+    while beginning_of_week <= end_date:
+        end_of_week = get_end_of_week(beginning_of_week)
+        stats = stats_by_week.get(beginning_of_week.date())
+        bucket = {'year': end_of_week.year, 'week': end_of_week.isocalendar()[1]}
+        for field in fields:
+            bucket[field] = (getattr(stats, field) or 0) if stats is not None else 0
+        buckets.append(bucket)
+        beginning_of_week = beginning_of_week + timedelta(weeks=1)
+
+    return buckets
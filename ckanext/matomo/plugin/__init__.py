@@ -8,7 +8,11 @@ from ckan.lib.plugins import DefaultTranslation
 
 from ckanext.matomo.cli import get_commands
 from ckanext.matomo import helpers
+from ckanext.matomo import matomo_api
+from ckanext.matomo import cache
+from ckanext.matomo import tracking
 import ckanext.matomo.logic as logic
+import ckanext.matomo.auth as auth
 
 try:
     from ckanext.report.interfaces import IReport
@@ -31,6 +35,7 @@ class MatomoPlugin(MixinPlugin, plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.ITranslation)
 
     if toolkit.check_ckan_version(min_version="2.9"):
@@ -57,6 +62,22 @@ class MatomoPlugin(MixinPlugin, plugins.SingletonPlugin, DefaultTranslation):
             if not config.get(config_option):
                 raise Exception(u"Config option `{0}` must be set to use Matomo".format(config_option))
 
+        # Tracking is set up lazily on the first tracked request, so check its options at startup
+        tracking.tracking_dispatcher_options(config)
+        tracking.tracking_buffer_options(config)
+
+        matomo_api.configure_session(
+            pool_size=toolkit.asint(config.get('ckanext.matomo.http_pool_size', matomo_api.DEFAULT_POOL_SIZE)),
+            max_retries=toolkit.asint(config.get('ckanext.matomo.http_max_retries', matomo_api.DEFAULT_MAX_RETRIES)),
+            backoff_factor=float(config.get('ckanext.matomo.http_backoff_factor', matomo_api.DEFAULT_BACKOFF_FACTOR)))
+
+        cache.configure(
+            backend=config.get('ckanext.matomo.cache_backend', cache.DEFAULT_CACHE_BACKEND),
+            ttl=toolkit.asint(config.get('ckanext.matomo.cache_ttl', cache.DEFAULT_CACHE_TTL)),
+            maxsize=toolkit.asint(config.get('ckanext.matomo.cache_size', cache.DEFAULT_CACHE_SIZE)),
+            entity_maxsize=toolkit.asint(config.get('ckanext.matomo.entity_cache_size',
+                                                    cache.DEFAULT_ENTITY_CACHE_SIZE)))
+
     # ITemplateHelpers
 
     def get_helpers(self):
@@ -85,7 +106,13 @@ class MatomoPlugin(MixinPlugin, plugins.SingletonPlugin, DefaultTranslation):
     # IActions
 
     def get_actions(self):
-        return {'most_visited_packages': logic.most_visited_packages}
+        return {'most_visited_packages': logic.most_visited_packages,
+                'matomo_tracking_stats': logic.matomo_tracking_stats}
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return {'matomo_tracking_stats': auth.matomo_tracking_stats}
 
     # ITranslation
     def i18n_directory(self):
@@ -1,14 +1,25 @@
 from datetime import datetime, timedelta
-from typing import List, Generator, Dict, Any, Optional
+from typing import List, Generator, Dict, Any, Optional, Tuple
 from ckan.plugins.toolkit import get_action
 from ckanext.report import lib as report
-from ckanext.matomo.model import PackageStats, ResourceStats, AudienceLocationDate, SearchStats
-from ckanext.matomo.utils import package_generator, get_report_years, last_calendar_period
+from ckanext.matomo.cache import cached
+from ckanext.matomo.model import PackageStats, ResourceStats, AudienceLocationDate, SearchStats, \
+                                 ORGANIZATION_DATASET_SORT_COLUMNS, ORGANIZATION_RESOURCE_SORT_COLUMNS
+from ckanext.matomo.utils import get_report_years, last_calendar_period
 from ckanext.matomo.types import VisitsByOrganization, VisitsByPackage, VisitsByResource, GroupedVisits, TimeOptions, \
-                                 OrganizationAndTimeOptions, Report
+                                 OrganizationAndTimeOptions, PagedReportOptions, Report
 
 log = __import__('logging').getLogger(__name__)
 
+# Report options are strings as they are given as url parameters
+DEFAULT_REPORT_PAGE = '1'
+DEFAULT_REPORT_PAGE_SIZE = '100'
+MAX_REPORT_PAGE_SIZE = 1000
+# Page size option for the whole unpaged table, used for exports
+REPORT_PAGE_SIZE_ALL = 'all'
+# Columns sorted in ascending order, other columns are sorted in descending order
+ASCENDING_SORT_COLUMNS = ('package_name', 'resource_name')
+
 
 try:
     from ckan.common import OrderedDict
@@ -32,6 +43,46 @@ def org_and_time_option_combinations() -> Generator[OrganizationAndTimeOptions,
             yield {'organization': org, 'time': time}
 
 
+def paged_option_combinations(sort_by: str):
+    '''
+    Returns a function yielding the organization and time option combinations
+    with the default page options, which are the report variants generated in advance
+    '''
+    def option_combinations() -> Generator[PagedReportOptions, None, None]:
+        for options in org_and_time_option_combinations():
+            yield {**options, 'page': DEFAULT_REPORT_PAGE, 'limit': DEFAULT_REPORT_PAGE_SIZE, 'sort_by': sort_by}
+    return option_combinations
+
+
+def _int_option(value, default: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return int(default)
+
+
+def _page_options(page, limit) -> Tuple[int, Optional[int]]:
+    '''
+    Returns the page number and page size, the page size is None for the whole table.
+    Options come from url parameters, invalid values fall back to the defaults.
+    '''
+    if limit == REPORT_PAGE_SIZE_ALL:
+        return 1, None
+    page = _int_option(page, DEFAULT_REPORT_PAGE)
+    limit = _int_option(limit, DEFAULT_REPORT_PAGE_SIZE)
+    return max(page, 1), min(max(limit, 1), MAX_REPORT_PAGE_SIZE)
+
+
+def _sort_option(sort_by, sort_columns: Tuple[str, ...], default: str) -> str:
+    return sort_by if sort_by in sort_columns else default
+
+
+def _organization_id(organization_name: str) -> str:
+    organization = get_action('organization_show')(
+        {}, {'id': organization_name})
+    return organization.get('id')
+
+
 def matomo_organization_list(start_date: datetime,
                              end_date: datetime,
                              descending=True,
@@ -42,46 +93,12 @@ def matomo_organization_list(start_date: datetime,
         only_orgs_with_packages=True)
 
 
+    # Fetch total visits per organization within given date range
     totals_by_organization: GroupedVisits = {}
     if report_type == 'dataset':
-        # Fetch total visits per dataset within given date range
-        package_stats: List[VisitsByPackage] = PackageStats.get_total_visits(
-            start_date, end_date, descending)
-
-        # Count org specific sums
-        for stat in package_stats:
-            organization_id: Optional[str] = stat.get('owner_org', None)
-            if organization_id:
-                is_new = not bool(totals_by_organization.get(organization_id))
-                if is_new:
-                    totals_by_organization[organization_id] = {}
-                totals_by_organization[organization_id]['visits'] = totals_by_organization[organization_id].get(
-                    'visits', 0) + stat.get('visits', 0)
-                totals_by_organization[organization_id]['entrances'] = totals_by_organization[organization_id].get(
-                    'entrances', 0) + stat.get('entrances', 0)
-                totals_by_organization[organization_id]['downloads'] = totals_by_organization[organization_id].get(
-                    'downloads', 0) + stat.get('downloads', 0)
-                totals_by_organization[organization_id]['events'] = totals_by_organization[organization_id].get(
-                    'events', 0) + stat.get('events', 0)
-
+        totals_by_organization = PackageStats.get_total_visits_by_organization(start_date, end_date)
     elif report_type == 'resource':
-        # Fetch total visits per resource within given date range
-        resource_stats: List[VisitsByResource] = ResourceStats.get_total_downloads(
-            start_date, end_date, descending)
-
-        # Count org specific sums
-        for stat in resource_stats:
-            organization_id: Optional[str] = stat.get('owner_org', None)
-            if organization_id:
-                is_new = not bool(totals_by_organization.get(organization_id))
-                if is_new:
-                    totals_by_organization[organization_id] = {}
-                totals_by_organization[organization_id]['visits'] = totals_by_organization[organization_id].get(
-                    'visits', 0) + stat.get('visits', 0)
-                totals_by_organization[organization_id]['downloads'] = totals_by_organization[organization_id].get(
-                    'downloads', 0) + stat.get('downloads', 0)
-                totals_by_organization[organization_id]['events'] = totals_by_organization[organization_id].get(
-                    'events', 0) + stat.get('events', 0)
+        totals_by_organization = ResourceStats.get_total_downloads_by_organization(start_date, end_date)
 
     # Format into list of org dicts with stats totals
     organizations: List[VisitsByOrganization] = []
@@ -105,54 +122,30 @@ def matomo_organization_list(start_date: datetime,
     return sorted(organizations, key=lambda organization: organization[sort_by], reverse=descending)
 
 
-def matomo_datasets_by_organization(organization_name: str,
+def matomo_datasets_by_organization(organization_id: str,
                                     start_date: datetime,
                                     end_date: datetime,
                                     descending=True,
-                                    sort_by='visits') -> List[VisitsByPackage]:
-    organization = get_action('organization_show')(
-        {}, {'id': organization_name})
-    organization_id: str = organization.get('id')
-
-    datasets: Generator[Dict[str, Any], None, None] = package_generator('*:*', 1000,
-                                                                        fq='+owner_org:%s' % organization_id,
-                                                                        fl='id,name,title,extras_title_translated')
-
-    # Fetch total visits per package within given date range
-    package_stats: List[VisitsByPackage] = PackageStats.get_total_visits(start_date=start_date,
-                                                                         end_date=end_date,
-                                                                         descending=True,
-                                                                         organization_id=organization_id)
-
-    visits_by_dataset: GroupedVisits = {
-        pkg.get('package_id', ''): {'visits': pkg.get('visits', 0),
-                                    'entrances': pkg.get('entrances', 0),
-                                    'downloads': pkg.get('downloads', 0),
-                                    'events': pkg.get('events', 0)}
-        for pkg in package_stats}
-
-    # Map the visit data onto relevant datasets
-    result: List[VisitsByPackage] = []
-    for dataset in datasets:
-        id: str = dataset.get('id', '')
-        visit = visits_by_dataset.get(id, {})
-        result.append({
-            "package_id": id,
-            "package_name": dataset.get('name'),
-            "package_title_translated": dataset.get('title_translated', None),
-            "visits": visit.get('visits', 0),
-            "entrances": visit.get('entrances', 0),
-            "downloads": visit.get('downloads', 0),
-            "events": visit.get('events', 0)
-        })
-
-    return sorted(result, key=lambda dataset: dataset[sort_by], reverse=descending)
-
-
-def matomo_dataset_report(organization: str, time: str) -> Dict[str, Any]:
+                                    sort_by='visits',
+                                    limit: Optional[int] = None,
+                                    offset: int = 0) -> List[VisitsByPackage]:
+    # Fetch the datasets of the organization with their total visits within given date range
+    return PackageStats.get_organization_datasets(organization_id=organization_id,
+                                                  start_date=start_date,
+                                                  end_date=end_date,
+                                                  sort_by=sort_by,
+                                                  descending=descending,
+                                                  limit=limit,
+                                                  offset=offset)
+
+
+@cached
+def matomo_dataset_report(organization: str, time: str, page=DEFAULT_REPORT_PAGE, limit=DEFAULT_REPORT_PAGE_SIZE,
+                          sort_by='visits') -> Report:
     '''
     Generates report based on matomo data.
-    Total sum of package visits per organization or number of views per package for selected organization
+    Total sum of package visits per organization or number of views per package for selected organization,
+    one page of limit datasets at a time sorted by sort_by, or all of them with limit 'all'
     '''
     organization_name: str = organization
     start_date, end_date = last_calendar_period(time)
@@ -163,13 +156,23 @@ def matomo_dataset_report(organization: str, time: str) -> Dict[str, Any]:
             'report_name': 'matomo-dataset',
             'table': matomo_organization_list(start_date, end_date, descending=True, sort_by='visits', report_type='dataset')
         }
-    else:
-        # get given organizations datasets with the popularity statistics
-        return {
-            'report_name': 'matomo-dataset',
-            'table': matomo_datasets_by_organization(organization_name=organization_name, start_date=start_date,
-                                                     end_date=end_date, descending=True, sort_by='visits')
-        }
+
+    sort_by = _sort_option(sort_by, ORGANIZATION_DATASET_SORT_COLUMNS, 'visits')
+    page, limit = _page_options(page, limit)
+
+    organization_id = _organization_id(organization_name)
+
+    # get given organizations datasets with the popularity statistics
+    return {
+        'report_name': 'matomo-dataset',
+        'table': matomo_datasets_by_organization(organization_id=organization_id, start_date=start_date,
+                                                 end_date=end_date, descending=sort_by not in ASCENDING_SORT_COLUMNS,
+                                                 sort_by=sort_by, limit=limit, offset=(page - 1) * (limit or 0)),
+        'total': PackageStats.count_organization_datasets(organization_id),
+        'page': page,
+        'limit': limit,
+        'sort_by': sort_by
+    }
 
 
 def matomo_dataset_report_info():
@@ -179,63 +182,41 @@ def matomo_dataset_report_info():
         'description': 'Matomo showing top datasets with most views by organization',
         'description_template': 'report/dataset_analytics_description.html',
         'option_defaults': OrderedDict((('organization', None),
-                                        ('time', 'month'),)),
-        'option_combinations': org_and_time_option_combinations,
+                                        ('time', 'month'),
+                                        ('sort_by', 'visits'),
+                                        ('limit', DEFAULT_REPORT_PAGE_SIZE),
+                                        ('page', DEFAULT_REPORT_PAGE),)),
+        'option_combinations': paged_option_combinations('visits'),
         'generate': matomo_dataset_report,
         'template': 'report/dataset_analytics.html',
     }
 
 
-def matomo_resources_by_organization(organization_name: str,
+def matomo_resources_by_organization(organization_id: str,
                                      start_date: datetime,
                                      end_date: datetime,
                                      descending=True,
-                                     sort_by='downloads') -> List[VisitsByResource]:
-    organization = get_action('organization_show')(
-        {}, {'id': organization_name})
-    organization_id: str = organization.get('id')
-
-    packages: Generator[Dict[str, Any], None, None] = package_generator('*:*', 1000,
-                                                                        fq='+owner_org:%s' % organization_id)
-    # Fetch total visits per package within given date range
-    resource_stats: List[VisitsByResource] = ResourceStats.get_total_downloads(start_date=start_date,
-                                                                               end_date=end_date,
-                                                                               descending=True,
-                                                                               organization_id=organization_id)
-
-    visits_by_resource: GroupedVisits = {
-        res.get('resource_id', ''): {'visits': res.get('visits', 0),
-                                     'downloads': res.get('downloads', 0),
-                                     'events': res.get('events', 0),
-                                     'visit_date': res.get('visit_date', '')}
-        for res in resource_stats}
-
-    # Map the visit data onto relevant resources
-    result: List[VisitsByResource] = []
-    for package in packages:
-        package_id: str = package.get('id', '')
-        for resource in package.get('resources', []):
-            resource_id = resource.get('id')
-            visit = visits_by_resource.get(resource_id, {})
-            result.append(
-                {'resource_id': resource_id, 'resource_name': resource.get('name', ''),
-                 'resource_name_translated': resource.get('name_translated'),
-                 'package_id': package_id, 'package_name': package.get('name', ''), 'package_title': package.get('title', ''),
-                 'package_title_translated': package.get('title_translated'),
-                 'owner_org': package.get('owner_org'),
-                 'visits': visit.get('visits', 0),
-                 'downloads': visit.get('downloads', 0),
-                 'events': visit.get('events', 0),
-                 'visit_date': visit.get('visit_date', '')})
-
-    return sorted(result, key=lambda dataset: dataset[sort_by], reverse=descending)
-
-
-def matomo_resource_report(organization: str, time: str) -> Report:
+                                     sort_by='downloads',
+                                     limit: Optional[int] = None,
+                                     offset: int = 0) -> List[VisitsByResource]:
+    # Fetch the resources of the organization's datasets with their total downloads within given date range
+    return ResourceStats.get_organization_resources(organization_id=organization_id,
+                                                    start_date=start_date,
+                                                    end_date=end_date,
+                                                    sort_by=sort_by,
+                                                    descending=descending,
+                                                    limit=limit,
+                                                    offset=offset)
+
+
+@cached
+def matomo_resource_report(organization: str, time: str, page=DEFAULT_REPORT_PAGE, limit=DEFAULT_REPORT_PAGE_SIZE,
+                           sort_by='downloads') -> Report:
     '''
     Generates report based on matomo data.
     Total sum of resource dowloands per organization (all resources of all organization's packages)
-    or number of downloads per resource for selected organization
+    or number of downloads per resource for selected organization, one page of limit resources
+    at a time sorted by sort_by, or all of them with limit 'all'
     '''
     organization_name: str = organization
     start_date, end_date = last_calendar_period(time)
@@ -248,10 +229,20 @@ def matomo_resource_report(organization: str, time: str) -> Report:
                                               sort_by='downloads', report_type='resource')
         }
 
+    sort_by = _sort_option(sort_by, ORGANIZATION_RESOURCE_SORT_COLUMNS, 'downloads')
+    page, limit = _page_options(page, limit)
+
+    organization_id = _organization_id(organization_name)
+
     return {
         'report_name': 'matomo-resource',
-        'table': matomo_resources_by_organization(organization_name=organization_name, start_date=start_date,
-                                                  end_date=end_date, descending=True, sort_by='downloads')
+        'table': matomo_resources_by_organization(organization_id=organization_id, start_date=start_date,
+                                                  end_date=end_date, descending=sort_by not in ASCENDING_SORT_COLUMNS,
+                                                  sort_by=sort_by, limit=limit, offset=(page - 1) * (limit or 0)),
+        'total': ResourceStats.count_organization_resources(organization_id),
+        'page': page,
+        'limit': limit,
+        'sort_by': sort_by
     }
 
 
@@ -262,44 +253,74 @@ def matomo_resource_report_info():
         'description': 'Matomo showing most downloaded resources',
         'description_template': 'report/resource_analytics_description.html',
         'option_defaults': OrderedDict((('organization', None),
-                                        ('time', 'month'),)),
-        'option_combinations': org_and_time_option_combinations,
+                                        ('time', 'month'),
+                                        ('sort_by', 'downloads'),
+                                        ('limit', DEFAULT_REPORT_PAGE_SIZE),
+                                        ('page', DEFAULT_REPORT_PAGE),)),
+        'option_combinations': paged_option_combinations('downloads'),
         'generate': matomo_resource_report,
         'template': 'report/resource_analytics.html'
     }
 
 
+def _location_to_rest(locations: List[Dict[str, Any]], location_name: str, period: str) -> List[Dict[str, Any]]:
+    location_visits = 0
+    rest_visits = 0
+    if any(location['location_name'] == location_name for location in locations):
+        for location in locations:
+            if location['location_name'] == location_name:
+                location_visits += location[period]
+            elif location['location_name'] is not None:
+                rest_visits += location[period]
+
+    return [{'location_name': location_name, 'total_visits': location_visits},
+            {'location_name': 'Other', 'total_visits': rest_visits}]
+
+
+def _top_locations(locations: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    # Visits without a location are only counted in the total and thus in "Other"
+    all_visits = sum(location['total_visits'] for location in locations)
+    named_locations = [location for location in locations if location['location_name'] is not None]
+    top_locations = [{'location_name': location['location_name'], 'total_visits': location['total_visits']}
+                     for location in named_locations[:limit]]
+    top_locations.append({
+        'location_name': 'Other',
+        'total_visits': all_visits - sum(location['total_visits'] for location in top_locations)
+    })
+
+    for location in top_locations:
+        location['percent_visits'] = 100.0 * location['total_visits'] / all_visits if all_visits != 0 else 0.0
+
+    return top_locations
+
+
+@cached
 def matomo_location_report():
     '''
     Generates report based on matomo data. number of sessions per location
     '''
-
-    top_locations = AudienceLocationDate.get_total_top_locations(20)
-
-    last_month_end = datetime.today().replace(day=1) - timedelta(days=1)
+    today = datetime.today()
+    last_month_end = today.replace(day=1) - timedelta(days=1)
     last_month_start = last_month_end.replace(day=1)
-    finland_vs_world_last_month = AudienceLocationDate.special_total_location_to_rest(last_month_start, last_month_end,
-                                                                                      'Finland')
-
-    finland_vs_world_all = AudienceLocationDate.special_total_location_to_rest(datetime(2000, 1, 1), datetime.today(),
-                                                                               'Finland')
-
-    sessions_by_month = AudienceLocationDate.special_total_by_months()
 
-    data_for_export = AudienceLocationDate.special_total_by_months(
-        datetime(2000, 1, 1), last_month_end)
+    # All location figures are computed from one query by location and one by month
+    locations = AudienceLocationDate.get_location_summary({'last_month': (last_month_start, last_month_end),
+                                                           'all': (datetime(2000, 1, 1), today)})
+    months = AudienceLocationDate.get_monthly_summary({'last_year': (last_month_end - timedelta(days=365),
+                                                                     last_month_end),
+                                                       'all': (datetime(2000, 1, 1), last_month_end)})
 
-    first_date = AudienceLocationDate.get_first_date()
+    first_date = min((location['first_date'] for location in locations), default=None)
 
     # first item in table list will be available for export
     return {
-        'table': data_for_export,
+        'table': months['all'],
         'data': {
             'first_date': first_date.date().isoformat() if first_date is not None else '-',
-            'top_locations': top_locations,
-            'finland_vs_world_last_month': finland_vs_world_last_month,
-            'finland_vs_world_all': finland_vs_world_all,
-            'sessions_by_month': sessions_by_month,
+            'top_locations': _top_locations(locations, 20),
+            'finland_vs_world_last_month': _location_to_rest(locations, 'Finland', 'last_month'),
+            'finland_vs_world_all': _location_to_rest(locations, 'Finland', 'all'),
+            'sessions_by_month': months['last_year'],
         }
     }
 
@@ -316,6 +337,7 @@ def matomo_location_report_info():
     }
 
 
+@cached
 def matomo_most_popular_search_terms(time):
     start_date, end_date = last_calendar_period(time)
     most_popular_search_terms = SearchStats.get_most_popular_search_terms(
@@ -0,0 +1,88 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+from typing import Any, Dict, List, Tuple
+
+log = __import__('logging').getLogger(__name__)
+
+SPOOL_FILENAME = 'tracking_spool.sqlite'
+# Claimed events not removed or released within this many seconds can be claimed again
+DEFAULT_CLAIM_TIMEOUT = 600
+
+
+class TrackingSpool(object):
+    '''
+    Append-only local spool for tracking events stored in a SQLite database in WAL mode.
+
+    Web workers append events cheaply, a drainer claims batches of events, sends them
+    to Matomo and removes them when sending succeeded or releases them to be retried later.
+    '''
+    def __init__(self, directory, claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+        self.path = os.path.join(directory, SPOOL_FILENAME)
+        self.claim_timeout = claim_timeout
+        self.local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can't be shared between threads or forked processes
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS events ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'event TEXT NOT NULL, '
+                               'claimed_at REAL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def append(self, event: Dict[str, Any], extra_headers=None) -> None:
+        self._connection().execute('INSERT INTO events (event) VALUES (?)',
+                                   (json.dumps({'event': event, 'headers': extra_headers or {}}),))
+
+    def claim(self, limit: int) -> List[Tuple[int, Dict[str, Any], Dict[str, str]]]:
+        '''
+        Claims at most limit unclaimed events in insertion order
+
+        :return: [(id, event, extra_headers), ...]
+        '''
+        now = time.time()
+        with self._transaction() as connection:
+            rows = connection.execute('SELECT id, event FROM events '
+                                      'WHERE claimed_at IS NULL OR claimed_at < ? '
+                                      'ORDER BY id LIMIT ?', (now - self.claim_timeout, limit)).fetchall()
+            connection.executemany('UPDATE events SET claimed_at = ? WHERE id = ?', [(now, row[0]) for row in rows])
+
+        claimed = []
+        for event_id, data in rows:
+            item = json.loads(data)
+            claimed.append((event_id, item['event'], item['headers']))
+        return claimed
+
+    def remove(self, ids: List[int]) -> None:
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM events WHERE id = ?', [(event_id,) for event_id in ids])
+
+    def release(self, ids: List[int]) -> None:
+        with self._transaction() as connection:
+            connection.executemany('UPDATE events SET claimed_at = NULL WHERE id = ?',
+                                   [(event_id,) for event_id in ids])
+
+    def count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM events').fetchone()[0]
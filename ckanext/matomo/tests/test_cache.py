@@ -0,0 +1,118 @@
+import logging
+import pytest
+from ckanext.matomo import cache
+from ckanext.matomo.cache import LRUCache, ResultCache, request_memoized
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru_cache = LRUCache(maxsize=2)
+    lru_cache.set('a', 1)
+    lru_cache.set('b', 2)
+    assert lru_cache.get('a') == 1
+    lru_cache.set('c', 3)
+
+    assert lru_cache.get('a') == 1
+    assert lru_cache.get('b') is None
+    assert lru_cache.get('c') == 3
+
+
+def test_lru_cache_expires_entries():
+    lru_cache = LRUCache(ttl=-1)
+    lru_cache.set('a', 1)
+
+    assert lru_cache.get('a') is None
+    assert len(lru_cache) == 0
+
+
+def test_result_cache_is_invalidated():
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        return {'value': value}
+
+    result_cache = ResultCache()
+    assert result_cache.call('compute', compute, 1) == {'value': 1}
+    assert result_cache.call('compute', compute, 1) == {'value': 1}
+    assert result_cache.call('compute', compute, 2) == {'value': 2}
+    assert calls == [1, 2]
+
+    result_cache.invalidate()
+    result_cache.call('compute', compute, 1)
+    assert calls == [1, 2, 1]
+
+
+def test_request_memoized():
+    from flask import Flask
+    calls = []
+
+    @request_memoized
+    def compute(value):
+        calls.append(value)
+        return value
+
+    app = Flask(__name__)
+    with app.test_request_context():
+        compute(1)
+        compute(1)
+    with app.test_request_context():
+        compute(1)
+
+    assert calls == [1, 1]
+
+
+class _FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key) or 0) + 1
+        return self.values[key]
+
+
+def _unreachable_redis():
+    raise ConnectionError('redis is down')
+
+
+def test_result_cache_is_invalidated_by_other_processes(monkeypatch):
+    redis = _FakeRedis()
+    monkeypatch.setattr(ResultCache, '_redis', lambda self: redis)
+    monkeypatch.setattr(cache, 'GENERATION_CHECK_INTERVAL', -1)
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        return value
+
+    web_cache = ResultCache()
+    web_cache.call('compute', compute, 1)
+    # fetch runs in another process with its own cache
+    ResultCache().invalidate()
+    web_cache.call('compute', compute, 1)
+
+    assert calls == [1, 1]
+
+
+def test_result_cache_checks_redis(monkeypatch, caplog):
+    monkeypatch.setattr(ResultCache, '_redis', lambda self: _unreachable_redis())
+
+    with pytest.raises(RuntimeError):
+        ResultCache(backend=cache.BACKEND_REDIS).check_shared_generation()
+    with caplog.at_level(logging.WARNING, logger=cache.__name__):
+        assert ResultCache().check_shared_generation() is False
+    assert 'Could not connect to redis' in caplog.text
+
+
+def test_result_cache_warns_once_when_redis_is_unreachable(monkeypatch, caplog):
+    monkeypatch.setattr(ResultCache, '_redis', lambda self: _unreachable_redis())
+    monkeypatch.setattr(cache, 'GENERATION_CHECK_INTERVAL', -1)
+    result_cache = ResultCache()
+
+    with caplog.at_level(logging.WARNING, logger=cache.__name__):
+        for _index in range(3):
+            result_cache.generation()
+
+    assert len([record for record in caplog.records if 'cache generation' in record.getMessage()]) == 1
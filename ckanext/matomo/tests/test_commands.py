@@ -0,0 +1,129 @@
+import datetime
+import pytest
+import ckan.model as model
+import ckan.tests.factories as factories
+from sqlalchemy import event
+from ckanext.matomo import commands
+from ckanext.matomo.commands import (init_db, resolve_packages, resolve_resources, date_windows,
+                                      StatsWriter, PACKAGE_STATS, PACKAGE_EVENTS)
+from ckanext.matomo.model import PackageStats
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_resolve_packages_by_name_and_id(app):
+    init_db()
+    organization = factories.Organization()
+    dataset = factories.Dataset(owner_org=organization['id'])
+    other_dataset = factories.Dataset()
+
+    packages = resolve_packages([dataset['name'], other_dataset['id'], 'missing-dataset'])
+
+    assert packages[dataset['name']]['id'] == dataset['id']
+    assert packages[dataset['id']]['owner_org'] == organization['id']
+    assert packages[other_dataset['name']]['type'] == 'dataset'
+    assert 'missing-dataset' not in packages
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_resolve_resources_skips_missing(app):
+    init_db()
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'])
+
+    resources = resolve_resources([resource['id'], 'missing-resource'])
+
+    assert resources[resource['id']]['package_id'] == dataset['id']
+    assert 'missing-resource' not in resources
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_parse_statistics_strips_padded_package_names(app):
+    init_db()
+    dataset = factories.Dataset()
+    reports = {
+        'dataset_page_statistics': {
+            '2022-11-01': {' {} ?q=test'.format(dataset['name']): [{'nb_hits': 3, 'entry_nb_visits': 1}]}
+        },
+        'resource_download_statistics': {},
+        'package_show_events': {},
+        'resource_page_statistics': {},
+        'datastore_search_sql_events': {},
+    }
+    writer = StatsWriter()
+
+    commands._parse_statistics(reports, writer, False, dataset['name'], None)
+
+    assert writer.rows_by_date['2022-11-01'][PACKAGE_STATS] == [
+        (dataset['id'], datetime.datetime(2022, 11, 1), 3, 1, 0, 0)
+    ]
+
+
+def test_date_windows():
+    since_date = datetime.date(2022, 11, 1)
+    until_date = datetime.date(2022, 11, 16)
+
+    assert date_windows(since_date, until_date) == [(since_date, until_date)]
+    assert date_windows(since_date, until_date, chunk_days=7) == [
+        (datetime.date(2022, 11, 1), datetime.date(2022, 11, 7)),
+        (datetime.date(2022, 11, 8), datetime.date(2022, 11, 14)),
+        (datetime.date(2022, 11, 15), datetime.date(2022, 11, 16)),
+    ]
+    with pytest.raises(ValueError):
+        date_windows(since_date, until_date, chunk_days=0)
+    with pytest.raises(ValueError):
+        date_windows(since_date, until_date, chunk_days=-1)
+
+
+def _package_visits(package_id):
+    stats = (model.Session.query(PackageStats)
+             .filter(PackageStats.package_id == package_id)
+             .order_by(PackageStats.visit_date)
+             .all())
+    return [(stat.visit_date.day, stat.visits) for stat in stats]
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_stats_writer_rolls_back_only_the_failing_day(app):
+    init_db()
+    package_id = '16364c67-251c-45dc-98d9-9e91105d1928'
+    writer = StatsWriter()
+    for day in range(1, 4):
+        writer.add('2022-11-0{}'.format(day), PACKAGE_STATS, (package_id, datetime.datetime(2022, 11, day), day, 0, 0, 0))
+    # Not a number, fails the whole second day
+    writer.add('2022-11-02', PACKAGE_EVENTS, (package_id, datetime.datetime(2022, 11, 2), 'invalid'))
+
+    writer.write()
+
+    assert _package_visits(package_id) == [(1, 1), (3, 3)]
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_stats_writer_commits_every_n_rows_and_every_day(app):
+    init_db()
+    commits = []
+
+    def count_commit(session):
+        commits.append(session)
+
+    writer = StatsWriter(commit_every=2)
+    for index in range(5):
+        writer.add('2022-11-01', PACKAGE_STATS, ('package-{}'.format(index), datetime.datetime(2022, 11, 1), 1, 0, 0, 0))
+    writer.add('2022-11-02', PACKAGE_STATS, ('package-0', datetime.datetime(2022, 11, 2), 'invalid', 0, 0, 0))
+
+    event.listen(model.Session, 'after_commit', count_commit)
+    try:
+        writer.write()
+    finally:
+        event.remove(model.Session, 'after_commit', count_commit)
+
+    # Two chunks of two rows and the rest of the first day, the failing second day is rolled back
+    assert len(commits) == 3
+    assert _package_visits('package-0') == [(1, 1)]
+    assert model.Session.query(PackageStats).count() == 5
+
+
+def test_stats_writer_rejects_commit_every_below_one():
+    with pytest.raises(ValueError):
+        StatsWriter(commit_every=0)
+    with pytest.raises(ValueError):
+        StatsWriter(commit_every=-1)
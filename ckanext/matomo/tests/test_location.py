@@ -0,0 +1,50 @@
+import pytest
+from datetime import datetime
+from ckanext.matomo.model import AudienceLocationDate
+from ckanext.matomo.commands import init_db
+from ckanext.matomo.reports import _top_locations, _location_to_rest
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_location_special_total_by_months(app):
+    init_db()
+    AudienceLocationDate.update_visits('Finland', datetime(2022, 10, 5), 1)
+    AudienceLocationDate.update_visits('Finland', datetime(2022, 11, 1), 10)
+    AudienceLocationDate.update_visits('Sweden', datetime(2022, 11, 20), 5)
+
+    months = AudienceLocationDate.special_total_by_months(datetime(2022, 10, 1), datetime(2022, 11, 30))
+
+    assert months == [{'combined_date': '10-2022', 'date': '2022-10-05 00:00:00', 'visits': 1},
+                      {'combined_date': '11-2022', 'date': '2022-11-20 00:00:00', 'visits': 15}]
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_location_summaries(app):
+    init_db()
+    AudienceLocationDate.update_visits('Finland', datetime(2022, 10, 5), 1)
+    AudienceLocationDate.update_visits('Finland', datetime(2022, 11, 1), 10)
+    AudienceLocationDate.update_visits('Sweden', datetime(2022, 11, 20), 5)
+
+    locations = AudienceLocationDate.get_location_summary({'november': (datetime(2022, 11, 1),
+                                                                        datetime(2022, 11, 30))})
+    months = AudienceLocationDate.get_monthly_summary({'all': (datetime(2022, 1, 1), datetime(2022, 12, 31)),
+                                                       'november': (datetime(2022, 11, 2), datetime(2022, 11, 30))})
+
+    assert locations == [{'location_name': 'Finland', 'total_visits': 11,
+                          'first_date': datetime(2022, 10, 5), 'november': 10},
+                         {'location_name': 'Sweden', 'total_visits': 5,
+                          'first_date': datetime(2022, 11, 20), 'november': 5}]
+    assert months['all'] == AudienceLocationDate.special_total_by_months(datetime(2022, 1, 1), datetime(2022, 12, 31))
+    assert months['november'] == [{'combined_date': '11-2022', 'date': '2022-11-20 00:00:00', 'visits': 5}]
+
+
+def test_location_report_counts_visits_without_location_as_other():
+    locations = [{'location_name': 'Finland', 'total_visits': 10, 'all': 10},
+                 {'location_name': None, 'total_visits': 6, 'all': 6},
+                 {'location_name': 'Sweden', 'total_visits': 4, 'all': 4}]
+
+    assert _top_locations(locations, 1) == [
+        {'location_name': 'Finland', 'total_visits': 10, 'percent_visits': 50.0},
+        {'location_name': 'Other', 'total_visits': 10, 'percent_visits': 50.0}]
+    assert _location_to_rest(locations, 'Finland', 'all') == [{'location_name': 'Finland', 'total_visits': 10},
+                                                              {'location_name': 'Other', 'total_visits': 4}]
@@ -0,0 +1,101 @@
+from unittest import mock
+from urllib.parse import parse_qs
+
+import pytest
+
+from ckanext.matomo.matomo_api import MatomoAPI, MatomoException, create_session, create_tracking_session
+
+
+def _api_with_response(response):
+    session = mock.Mock()
+    session.post.return_value.json.return_value = response
+    return MatomoAPI('https://matomo.example.com', 1, 'token', session=session), session
+
+
+def test_bulk_packs_requests_and_splits_results():
+    api, session = _api_with_response([
+        [{'label': 'Finland', 'nb_visits': 3}],
+        {'2022-11-01': [{'label': 'search', 'nb_visits': 2}]},
+    ])
+
+    results = api.bulk({'countries': api.visits_by_country_request(period='day', date='2022-11-01'),
+                        'search_terms': api.search_terms_request(period='day', date='2022-11-01,2022-11-02')})
+
+    assert results == {'countries': [{'label': 'Finland', 'nb_visits': 3}],
+                       'search_terms': {'2022-11-01': [{'label': 'search', 'nb_visits': 2}]}}
+
+    data = session.post.call_args.kwargs['data']
+    assert data['method'] == 'API.getBulkRequest'
+    assert data['token_auth'] == 'token'
+    assert parse_qs(data['urls[0]']) == {'idSite': ['1'], 'filter_limit': ['-1'], 'method': ['UserCountry.getCountry'],
+                                         'period': ['day'], 'date': ['2022-11-01'], 'flat': ['1']}
+    assert parse_qs(data['urls[1]'])['method'] == ['Actions.getSiteSearchKeywords']
+    assert 'urls[2]' not in data
+
+
+def test_bulk_raises_on_failed_entry():
+    api, _session = _api_with_response([
+        [],
+        {'result': 'error', 'message': 'Invalid date'},
+    ])
+
+    with pytest.raises(MatomoException, match='search_terms: Invalid date'):
+        api.bulk({'countries': api.visits_by_country_request(),
+                  'search_terms': api.search_terms_request()})
+
+
+@pytest.mark.parametrize('response', [
+    [[]],
+    [[], [], []],
+    {'countries': [], 'search_terms': []},
+])
+def test_bulk_raises_on_unexpected_number_of_results(response):
+    api, _session = _api_with_response(response)
+
+    with pytest.raises(MatomoException, match='Expected 2 results'):
+        api.bulk({'countries': api.visits_by_country_request(),
+                  'search_terms': api.search_terms_request()})
+
+
+def test_bulk_without_requests_does_not_call_matomo():
+    api, session = _api_with_response([])
+
+    assert api.bulk({}) == {}
+    session.post.assert_not_called()
+
+
+def test_reporting_session_retries_reads_statuses_and_post():
+    retry = create_session(max_retries=3).get_adapter('https://matomo.example.com').max_retries
+
+    assert retry.total == 3
+    assert retry.read is None
+    assert 503 in retry.status_forcelist
+    assert retry.is_retry('POST', 503)
+
+
+def test_tracking_session_only_retries_connection_errors():
+    retry = create_tracking_session(max_retries=3).get_adapter('https://matomo.example.com').max_retries
+
+    assert retry.total == 3
+    assert retry.connect is None
+    assert retry.read == 0
+    assert retry.status == 0
+    assert 'POST' not in retry.allowed_methods
+    assert not retry.is_retry('GET', 503, has_retry_after=True)
+    assert not retry.is_retry('POST', 503)
+
+
+def test_tracking_bulk_posts_json_requests():
+    tracking_session = mock.Mock()
+    api = MatomoAPI('https://matomo.example.com', 1, 'token', session=mock.Mock(), tracking_session=tracking_session)
+
+    api.tracking_bulk([{'e_c': 'API', 'e_a': 'package_show'}, {'e_c': 'API', 'e_a': 'resource_show'}])
+
+    url = tracking_session.post.call_args.args[0]
+    data = tracking_session.post.call_args.kwargs['json']
+    assert url == 'https://matomo.example.com/matomo.php'
+    assert data['token_auth'] == 'token'
+    assert [request[0] for request in data['requests']] == ['?', '?']
+    params = [parse_qs(request[1:]) for request in data['requests']]
+    assert [event['e_a'] for event in params] == [['package_show'], ['resource_show']]
+    assert all(event['idsite'] == ['1'] and event['rec'] == ['1'] and event['rand'] for event in params)
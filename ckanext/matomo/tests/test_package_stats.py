@@ -1,6 +1,9 @@
 import pytest
-from datetime import datetime
-from ckanext.matomo.model import PackageStats
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+import ckan.plugins.toolkit as toolkit
+from datetime import datetime, timedelta
+from ckanext.matomo.model import PackageStats, get_last_year_weeks
 from ckanext.matomo.commands import init_db
 import logging
 log = logging.getLogger(__name__)
@@ -30,3 +33,135 @@ def test_package_update_visits(app):
     PackageStats.update_visits(package_id, stat_date, 2)
     package_stats = PackageStats.get(package_id)
     assert package_stats.__dict__.get('visits') == 2
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_package_bulk_upsert(app):
+    init_db()
+    package_id = '16364c67-251c-45dc-98d9-9e91105d1928'
+    stat_date = datetime.strptime('2022-11-10', '%Y-%m-%d')
+    PackageStats.bulk_upsert([(package_id, stat_date, 3, 2, 1, 4)])
+    PackageStats.bulk_upsert([(package_id, stat_date, 5)], fields=('downloads',))
+    package_stats = PackageStats.get(package_id)
+    assert package_stats.__dict__.get('visits') == 3
+    assert package_stats.__dict__.get('entrances') == 2
+    assert package_stats.__dict__.get('downloads') == 5
+    assert package_stats.__dict__.get('events') == 4
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_package_get_top(app):
+    init_db()
+    organization = factories.Organization()
+    dataset = factories.Dataset(title='Public dataset')
+    private_dataset = factories.Dataset(private=True, owner_org=organization['id'])
+    for day in range(1, 4):
+        stat_date = datetime(2022, 11, day)
+        PackageStats.update_visits(dataset['id'], stat_date, 5)
+        PackageStats.update_visits(private_dataset['id'], stat_date, 5)
+
+    packages = PackageStats.get_top().get('packages', [])
+
+    assert len(packages) == 1
+    assert packages[0]['package_id'] == dataset['id']
+    assert packages[0]['package_name'] == 'Public dataset'
+    assert packages[0]['visits'] == 15
+    assert packages[0]['visit_date'] == '03-11-2022'
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_most_visited_packages_with_fields(app):
+    init_db()
+    organization = factories.Organization()
+    dataset = factories.Dataset(owner_org=organization['id'])
+    other_dataset = factories.Dataset()
+    PackageStats.update_visits(dataset['id'], datetime(2022, 11, 1), 3)
+    PackageStats.update_visits(other_dataset['id'], datetime(2022, 11, 1), 7)
+
+    result = helpers.call_action('most_visited_packages', fields='name,owner_org')
+
+    assert result['packages'] == [
+        {'id': other_dataset['id'], 'name': other_dataset['name'], 'owner_org': other_dataset['owner_org'],
+         'visits': 7, 'visit_date': '01-11-2022'},
+        {'id': dataset['id'], 'name': dataset['name'], 'owner_org': organization['id'],
+         'visits': 3, 'visit_date': '01-11-2022'},
+    ]
+
+    with pytest.raises(toolkit.ValidationError):
+        helpers.call_action('most_visited_packages', fields='name,notes')
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_most_visited_packages_batched_matches_package_show(app):
+    init_db()
+    organization = factories.Organization()
+    datasets = [factories.Dataset() for _index in range(3)]
+    private_dataset = factories.Dataset(private=True, owner_org=organization['id'])
+    for visits, dataset in enumerate(datasets + [private_dataset], start=1):
+        PackageStats.update_visits(dataset['id'], datetime(2022, 11, 1), visits)
+
+    batched = helpers.call_action('most_visited_packages', batched=True, limit=3)
+    unbatched = helpers.call_action('most_visited_packages', limit=3)
+
+    assert [package['id'] for package in batched['packages']] == [package['id'] for package in unbatched['packages']]
+    assert private_dataset['id'] not in [package['id'] for package in batched['packages']]
+    assert len(batched['packages']) == 3
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_package_get_all_visits(app):
+    init_db()
+    dataset = factories.Dataset()
+    start_date, end_date = get_last_year_weeks(datetime.now())
+    PackageStats.update_visits(dataset['id'], start_date, 2)
+    PackageStats.update_visits(dataset['id'], start_date + timedelta(days=6), 3)
+    PackageStats.update_downloads(dataset['id'], end_date.replace(hour=0, minute=0, second=0, microsecond=0), 4)
+    PackageStats.update_visits(dataset['id'], start_date - timedelta(days=1), 5)
+
+    visits = PackageStats.get_all_visits(dataset['id'])
+
+    assert len(visits['visits']) == 52
+    assert visits['visits'][0]['visits'] == 5
+    assert visits['visits'][-1]['downloads'] == 4
+    assert visits['visits'][-1]['week'] == end_date.isocalendar()[1]
+    assert sum(week['visits'] for week in visits['visits']) == 5
+    assert visits['total_visits'] == 10
+    assert visits['total_downloads'] == 4
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_package_get_total_visits_by_organization(app):
+    init_db()
+    organization = factories.Organization()
+    dataset = factories.Dataset(owner_org=organization['id'])
+    other_dataset = factories.Dataset(owner_org=organization['id'])
+    private_dataset = factories.Dataset(owner_org=organization['id'], private=True)
+    stat_date = datetime(2022, 11, 10)
+    PackageStats.bulk_upsert([(dataset['id'], stat_date, 1, 2, 3, 4),
+                              (other_dataset['id'], stat_date, 10, 20, 30, 40),
+                              (private_dataset['id'], stat_date, 100, 100, 100, 100)])
+
+    totals = PackageStats.get_total_visits_by_organization(stat_date, stat_date)
+
+    assert totals == {organization['id']: {'visits': 11, 'entrances': 22, 'downloads': 33, 'events': 44}}
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_package_get_organization_datasets(app):
+    init_db()
+    organization = factories.Organization()
+    dataset = factories.Dataset(owner_org=organization['id'])
+    dataset_without_stats = factories.Dataset(owner_org=organization['id'])
+    factories.Dataset(owner_org=organization['id'], private=True)
+    factories.Dataset()
+    stat_date = datetime(2022, 11, 10)
+    PackageStats.bulk_upsert([(dataset['id'], stat_date, 1, 2, 3, 4)])
+
+    datasets = PackageStats.get_organization_datasets(organization['id'], stat_date, stat_date)
+
+    assert sorted(datasets, key=lambda row: row['visits']) == [
+        {'package_id': dataset_without_stats['id'], 'package_name': dataset_without_stats['name'],
+         'package_title_translated': None, 'visits': 0, 'entrances': 0, 'downloads': 0, 'events': 0},
+        {'package_id': dataset['id'], 'package_name': dataset['name'],
+         'package_title_translated': None, 'visits': 1, 'entrances': 2, 'downloads': 3, 'events': 4},
+    ]
@@ -1,10 +1,11 @@
 import pytest
 import ckan.tests.factories as factories
 from datetime import datetime, timedelta
-from ckanext.matomo.model import ResourceStats
+from ckanext.matomo.model import ResourceStats, get_last_year_weeks, weekly_buckets
 from ckanext.matomo.commands import init_db
 from ckanext.matomo.utils import last_calendar_period
 import uuid
+from collections import namedtuple
 
 
 @pytest.mark.freeze_time('2022-11-11')
@@ -87,3 +88,68 @@ def test_resource_get_top(app):
     assert resources[0].get('downloads') == 200
     assert resources[5].get('resource_id') == resource_ids[5]
     assert len(resources) == 20
+
+
+@pytest.mark.freeze_time('2022-11-11')
+@pytest.mark.usefixtures("clean_db")
+def test_resource_bulk_upsert(app):
+    init_db()
+    resource_id = '16364c67-251c-45dc-98d9-9e91105d1928'
+    stat_date = datetime.strptime('2022-11-10', '%Y-%m-%d')
+    ResourceStats.bulk_upsert([(resource_id, stat_date, 3), (resource_id, stat_date, 4)], fields=('downloads',))
+    ResourceStats.bulk_upsert([(resource_id, stat_date, 7)], fields=('visits',))
+    resource_stats = ResourceStats.get(resource_id)
+    assert resource_stats.__dict__.get('downloads') == 4
+    assert resource_stats.__dict__.get('visits') == 7
+    assert resource_stats.__dict__.get('events') == 0
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_resource_get_downloads_in_date_range_by_id(app):
+    init_db()
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'])
+    start_date, end_date = get_last_year_weeks(datetime.now())
+    ResourceStats.update_downloads(resource['id'], start_date + timedelta(days=1), 2)
+    ResourceStats.update_downloads(resource['id'], start_date + timedelta(weeks=2), 3)
+    ResourceStats.update_downloads(resource['id'], start_date - timedelta(days=1), 4)
+
+    downloads = ResourceStats.get_downloads_in_date_range_by_id(resource['id'], start_date, end_date)
+
+    assert [week['downloads'] for week in downloads['visits'][:4]] == [2, 0, 3, 0]
+    assert len(downloads['visits']) == 52
+    assert downloads['total_downloads'] == 9
+
+
+def test_weekly_buckets():
+    Row = namedtuple('Row', ['week', 'visits'])
+    start_date = datetime(2022, 12, 19)
+    end_date = datetime(2023, 1, 15, 23, 59, 59)
+
+    buckets = weekly_buckets(start_date, end_date, [Row(datetime(2023, 1, 2), 5)], ('visits',))
+
+    assert buckets == [{'year': 2022, 'week': 51, 'visits': 0},
+                       {'year': 2023, 'week': 52, 'visits': 0},
+                       {'year': 2023, 'week': 1, 'visits': 5},
+                       {'year': 2023, 'week': 2, 'visits': 0}]
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_resource_get_organization_resources_paged(app):
+    init_db()
+    organization = factories.Organization()
+    dataset = factories.Dataset(owner_org=organization['id'])
+    resources = [factories.Resource(package_id=dataset['id'], name='Resource {}'.format(i)) for i in range(3)]
+    stat_date = datetime(2022, 11, 10)
+    ResourceStats.bulk_upsert([(resource['id'], stat_date, downloads)
+                               for resource, downloads in zip(resources, (5, 1, 3))], fields=('downloads',))
+
+    first_page = ResourceStats.get_organization_resources(organization['id'], stat_date, stat_date, limit=2)
+    second_page = ResourceStats.get_organization_resources(organization['id'], stat_date, stat_date, limit=2, offset=2)
+    by_name = ResourceStats.get_organization_resources(organization['id'], stat_date, stat_date,
+                                                       sort_by='resource_name', descending=False)
+
+    assert [row['downloads'] for row in first_page] == [5, 3]
+    assert [row['downloads'] for row in second_page] == [1]
+    assert [row['resource_name'] for row in by_name] == ['Resource 0', 'Resource 1', 'Resource 2']
+    assert ResourceStats.count_organization_resources(organization['id']) == 3
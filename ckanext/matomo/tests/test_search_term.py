@@ -37,3 +37,20 @@ def test_most_popular_search_term_sorting(app):
     assert most_popular_search_terms[0].get('count') == 570
     assert most_popular_search_terms[0].get('search_term') == '{}-1'.format(search_term_base)
     assert most_popular_search_terms[0].get('count') > most_popular_search_terms[1].get('count')
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_most_popular_search_terms_normalized(app):
+    init_db()
+    stat_date = datetime.strptime('2022-11-10', '%Y-%m-%d')
+    SearchStats.update_search_term_count('Water', stat_date, 3)
+    SearchStats.update_search_term_count(' water', stat_date + timedelta(days=1), 4)
+    SearchStats.update_search_term_count('forest', stat_date, 5)
+
+    start_date, end_date = stat_date - timedelta(days=1), stat_date + timedelta(days=2)
+    most_popular_search_terms = SearchStats.get_most_popular_search_terms(start_date, end_date, limit=2)
+    normalized_search_terms = SearchStats.get_most_popular_search_terms(start_date, end_date, normalize=True)
+
+    assert [term.get('search_term') for term in most_popular_search_terms] == ['forest', ' water']
+    assert normalized_search_terms[0] == {'search_term': 'water', 'count': 7, 'latest_search_date': '2022-11-11'}
+    assert normalized_search_terms[1].get('search_term') == 'forest'
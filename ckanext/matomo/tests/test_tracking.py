@@ -0,0 +1,209 @@
+import threading
+import pytest
+from unittest import mock
+from ckanext.matomo import tracking
+from ckanext.matomo.tracking import TrackingBuffer, TrackingDispatcher, DROP_NEWEST, DROP_OLDEST
+from ckanext.matomo.spool import TrackingSpool
+
+
+def _blocked_dispatcher(drop_policy):
+    release = threading.Event()
+    dispatcher = TrackingDispatcher(max_queue_size=2, senders=1, drop_policy=drop_policy)
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+        return True
+
+    dispatcher.submit(block)
+    started.wait()
+    return dispatcher, release
+
+
+def test_tracking_dispatcher_drop_newest():
+    dispatcher, release = _blocked_dispatcher(DROP_NEWEST)
+    sent = []
+
+    def send(index):
+        sent.append(index)
+        return True
+
+    for index in range(4):
+        dispatcher.submit(send, index)
+
+    assert dispatcher.stats()['dropped'] == 2
+    release.set()
+    dispatcher.queue.join()
+    assert sent == [0, 1]
+
+
+def test_tracking_dispatcher_drop_oldest():
+    dispatcher, release = _blocked_dispatcher(DROP_OLDEST)
+    sent = []
+
+    def send(index):
+        sent.append(index)
+        return True
+
+    for index in range(4):
+        dispatcher.submit(send, index)
+
+    assert dispatcher.stats()['dropped'] == 2
+    release.set()
+    dispatcher.queue.join()
+    assert sent == [2, 3]
+    assert dispatcher.stats()['sent'] == 3
+
+
+def test_tracking_spool_claim_remove_and_release(tmp_path):
+    spool = TrackingSpool(str(tmp_path))
+    for index in range(3):
+        spool.append({'e_n': index}, {'dnt': '1'} if index == 2 else None)
+
+    claimed = spool.claim(2)
+    assert [event for _id, event, _headers in claimed] == [{'e_n': 0}, {'e_n': 1}]
+    # Claimed events are not handed out twice
+    assert [event for _id, event, _headers in spool.claim(2)] == [{'e_n': 2}]
+
+    spool.remove([claimed[0][0]])
+    spool.release([claimed[1][0]])
+    assert spool.count() == 2
+    assert [event for _id, event, _headers in spool.claim(2)] == [{'e_n': 1}]
+
+
+class _RecordingDispatcher(object):
+    def __init__(self):
+        self.submitted = []
+        self.event = threading.Event()
+
+    def submit(self, function, *args, events=1):
+        self.submitted.append((function, args, events))
+        self.event.set()
+
+
+def _recording_buffer(monkeypatch, **kwargs):
+    dispatcher = _RecordingDispatcher()
+    monkeypatch.setattr(tracking, 'get_tracking_dispatcher', lambda: dispatcher)
+    return TrackingBuffer(**kwargs), dispatcher
+
+
+def test_tracking_buffer_flushes_full_batch(monkeypatch):
+    tracking_buffer, dispatcher = _recording_buffer(monkeypatch, flush_interval=60)
+    for index in range(tracking.MAX_EVENTS_PER_MATOMO_REQUEST + 1):
+        tracking_buffer.add({'e_n': index})
+
+    assert len(dispatcher.submitted) == 1
+    function, (batch,), events = dispatcher.submitted[0]
+    assert function is tracking.matomo_track_bulk
+    assert batch == [{'e_n': index} for index in range(tracking.MAX_EVENTS_PER_MATOMO_REQUEST)]
+    assert events == tracking.MAX_EVENTS_PER_MATOMO_REQUEST
+    # The remaining event waits for the next batch or the timer
+    assert tracking_buffer.events == [{'e_n': tracking.MAX_EVENTS_PER_MATOMO_REQUEST}]
+    tracking_buffer.flush()
+
+
+def test_tracking_buffer_flushes_after_interval(monkeypatch):
+    tracking_buffer, dispatcher = _recording_buffer(monkeypatch, flush_interval=0.05)
+    tracking_buffer.add({'e_n': 1})
+    tracking_buffer.add({'e_n': 2})
+
+    assert dispatcher.event.wait(5)
+    assert dispatcher.submitted == [(tracking.matomo_track_bulk, ([{'e_n': 1}, {'e_n': 2}],), 2)]
+    assert tracking_buffer.events == []
+    assert tracking_buffer.timer is None
+
+
+def test_tracking_buffer_sends_events_with_headers_singly(monkeypatch):
+    tracking_buffer, dispatcher = _recording_buffer(monkeypatch, flush_interval=60)
+    tracking_buffer.add({'e_n': 1}, {'dnt': '1'})
+
+    assert dispatcher.submitted == [(tracking.matomo_track, ({'e_n': 1}, {'dnt': '1'}), 1)]
+    assert tracking_buffer.events == []
+    assert tracking_buffer.timer is None
+
+
+def _queued_dispatcher(items):
+    # Without submit, no sender threads are started and the items stay queued
+    dispatcher = TrackingDispatcher(max_queue_size=10)
+    sent = []
+
+    def send(index):
+        sent.append(index)
+        return True
+
+    for index in range(items):
+        dispatcher.queue.put_nowait((send, (index,), 2))
+    return dispatcher, sent
+
+
+def test_tracking_dispatcher_drain_stops_at_max_items():
+    dispatcher, sent = _queued_dispatcher(5)
+    dispatcher.drain(max_items=2)
+
+    assert sent == [0, 1]
+    assert dispatcher.stats() == {'enqueued': 0, 'sent': 4, 'dropped': 6, 'failed': 0, 'queue_size': 0}
+
+
+def test_tracking_dispatcher_drain_stops_at_deadline():
+    dispatcher, sent = _queued_dispatcher(3)
+    dispatcher.drain(timeout=0)
+
+    assert sent == []
+    assert dispatcher.stats()['dropped'] == 6
+    assert dispatcher.stats()['queue_size'] == 0
+
+
+def test_tracking_dispatcher_drain_sends_everything_in_time():
+    dispatcher, sent = _queued_dispatcher(3)
+    dispatcher.drain()
+
+    assert sent == [0, 1, 2]
+    assert dispatcher.stats()['dropped'] == 0
+
+
+def test_tracking_options_are_validated():
+    assert tracking.tracking_dispatcher_options({})['drop_policy'] == DROP_NEWEST
+    assert tracking.tracking_buffer_options({})['max_events'] == tracking.MAX_EVENTS_PER_MATOMO_REQUEST
+
+    for config in ({'ckanext.matomo.tracking_drop_policy': 'drop-all'},
+                   {'ckanext.matomo.tracking_queue_size': 'many'},
+                   {'ckanext.matomo.tracking_queue_size': '0'},
+                   {'ckanext.matomo.tracking_senders': '-1'}):
+        with pytest.raises(ValueError):
+            tracking.tracking_dispatcher_options(config)
+    with pytest.raises(ValueError):
+        tracking.tracking_buffer_options({'ckanext.matomo.tracking_batch_size': '0'})
+
+
+def _bulk_tracking_response(monkeypatch, body):
+    response = mock.Mock(ok=True, status_code=200)
+    response.json.return_value = body
+    api = mock.Mock()
+    api.tracking_bulk.return_value = response
+    monkeypatch.setattr(tracking, '_tracking_api', lambda: api)
+
+
+@pytest.mark.parametrize('body, failures', [
+    ({'status': 'success', 'tracked': 3, 'invalid': 0}, []),
+    ({'status': 'success', 'tracked': 2, 'invalid': 1, 'invalid_indices': [1]}, [1]),
+    ({'status': 'success', 'tracked': 2, 'invalid': 1}, [0, 1, 2]),
+    ({'status': 'success', 'tracked': 1, 'invalid': 0}, [0, 1, 2]),
+    ([], [0, 1, 2]),
+])
+def test_matomo_track_bulk_failures(monkeypatch, body, failures):
+    _bulk_tracking_response(monkeypatch, body)
+
+    assert tracking.matomo_track_bulk_failures([{'e_n': 0}, {'e_n': 1}, {'e_n': 2}]) == failures
+    assert tracking.matomo_track_bulk([{'e_n': 0}, {'e_n': 1}, {'e_n': 2}]) == (failures == [])
+
+
+def test_flush_tracking_spool_keeps_invalid_events(monkeypatch, tmp_path):
+    spool = TrackingSpool(str(tmp_path))
+    for index in range(3):
+        spool.append({'e_n': index}, None)
+    monkeypatch.setattr(tracking, 'get_tracking_spool', lambda: spool)
+    _bulk_tracking_response(monkeypatch, {'status': 'success', 'tracked': 2, 'invalid': 1, 'invalid_indices': [1]})
+
+    assert tracking.flush_tracking_spool() == {'sent': 2, 'failed': 1}
+    assert [event for _id, event, _headers in spool.claim(3)] == [{'e_n': 1}]
@@ -1,16 +1,333 @@
+import atexit
 import logging
 import datetime
+import os
+import queue
+import threading
+import time
+import requests
 
-from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
 
 from ckan.views.api import action as ckan_action
 import ckan.plugins.toolkit as toolkit
 
 from ckanext.matomo.matomo_api import MatomoAPI
+from ckanext.matomo.spool import TrackingSpool
 
 MAX_EVENTS_PER_MATOMO_REQUEST = 32
+DEFAULT_TRACKING_TIMEOUT = 10
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_SENDERS = 1
+DEFAULT_DRAIN_TIMEOUT = 10
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+# Minimum interval in seconds between warnings about dropped events
+DROP_WARNING_INTERVAL = 60
 log = logging.getLogger(__name__)
-tracking_executor = ThreadPoolExecutor(max_workers=1)
+
+
+class TrackingDispatcher(object):
+    '''
+    Sends tracking requests from a bounded queue with a fixed number of sender threads.
+
+    When the queue is full, either the new request (drop-newest) or the oldest queued
+    request (drop-oldest) is dropped, so a slow or unavailable Matomo can't make
+    the queue grow without limit. Counts of enqueued, sent, dropped and failed
+    events are kept for monitoring.
+    '''
+    def __init__(self, max_queue_size=DEFAULT_QUEUE_SIZE, senders=DEFAULT_SENDERS, drop_policy=DROP_NEWEST,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT):
+        if drop_policy not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError('Unknown tracking drop policy: {}'.format(drop_policy))
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.senders = senders
+        self.drop_policy = drop_policy
+        self.drain_timeout = drain_timeout
+        self.counters = {'enqueued': 0, 'sent': 0, 'dropped': 0, 'failed': 0}
+        self.counters_lock = threading.Lock()
+        self.threads = []
+        self.last_drop_warning = 0.0
+
+    def submit(self, function, *args, events=1):
+        '''
+        Queues function(*args) to be called by a sender thread.
+        The function sends the given number of events and returns True on success.
+        '''
+        self._start()
+        item = (function, args, events)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.drop_policy == DROP_OLDEST:
+                try:
+                    _function, _args, dropped_events = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self._count('dropped', dropped_events)
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(item)
+                except queue.Full:
+                    self._dropped(events)
+                    return
+            else:
+                self._dropped(events)
+                return
+        self._count('enqueued', events)
+
+    def stats(self):
+        with self.counters_lock:
+            result = dict(self.counters)
+        result['queue_size'] = self.queue.qsize()
+        return result
+
+    def drain(self, timeout=None, max_items=None):
+        '''
+        Sends queued requests in the calling thread until the queue is empty, timeout seconds
+        (default drain_timeout) have passed or max_items requests have been sent.
+        Requests still queued after that are dropped, so an unavailable Matomo can't block shutdown.
+        '''
+        deadline = time.monotonic() + (self.drain_timeout if timeout is None else timeout)
+        sent = 0
+        while time.monotonic() < deadline and (max_items is None or sent < max_items):
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self._send(item)
+            sent += 1
+
+        dropped = 0
+        while True:
+            try:
+                _function, _args, events = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            dropped += events
+        if dropped:
+            self._count('dropped', dropped)
+            log.warning('Dropped %d queued tracking events after sending %d requests at exit', dropped, sent)
+
+    def _start(self):
+        if self.threads:
+            return
+        with self.counters_lock:
+            if self.threads:
+                return
+            for index in range(self.senders):
+                thread = threading.Thread(target=self._run, name='matomo-tracking-{}'.format(index), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            self._send(self.queue.get())
+
+    def _send(self, item):
+        function, args, events = item
+        try:
+            success = function(*args)
+        except Exception as e:
+            log.exception('Error when sending tracking events to matomo: %s' % e)
+            success = False
+        finally:
+            self.queue.task_done()
+        self._count('sent' if success else 'failed', events)
+
+    def _count(self, counter, events):
+        with self.counters_lock:
+            self.counters[counter] += events
+
+    def _dropped(self, events):
+        self._count('dropped', events)
+        now = time.monotonic()
+        if now - self.last_drop_warning >= DROP_WARNING_INTERVAL:
+            self.last_drop_warning = now
+            log.warning('Matomo tracking queue is full, dropping events: %s', self.stats())
+
+
+_tracking_dispatcher = None
+_tracking_dispatcher_lock = threading.Lock()
+
+
+def tracking_dispatcher_options(config) -> Dict[str, Any]:
+    '''
+    Reads TrackingDispatcher options from config, raises ValueError for invalid values
+    '''
+    options = {
+        'max_queue_size': toolkit.asint(config.get('ckanext.matomo.tracking_queue_size', DEFAULT_QUEUE_SIZE)),
+        'senders': toolkit.asint(config.get('ckanext.matomo.tracking_senders', DEFAULT_SENDERS)),
+        'drop_policy': config.get('ckanext.matomo.tracking_drop_policy', DROP_NEWEST),
+        'drain_timeout': float(config.get('ckanext.matomo.tracking_drain_timeout', DEFAULT_DRAIN_TIMEOUT)),
+    }
+    if options['drop_policy'] not in (DROP_NEWEST, DROP_OLDEST):
+        raise ValueError('Unknown tracking drop policy: {}'.format(options['drop_policy']))
+    # A queue size below 1 would make the queue unbounded
+    if options['max_queue_size'] < 1 or options['senders'] < 1:
+        raise ValueError('Tracking queue size and number of senders must be at least 1')
+    return options
+
+
+def get_tracking_dispatcher() -> TrackingDispatcher:
+    global _tracking_dispatcher
+    if _tracking_dispatcher is None:
+        with _tracking_dispatcher_lock:
+            if _tracking_dispatcher is None:
+                _tracking_dispatcher = TrackingDispatcher(**tracking_dispatcher_options(toolkit.config))
+    return _tracking_dispatcher
+
+
+class TrackingBuffer(object):
+    '''
+    Collects tracking events in memory and sends them to Matomo as bulk tracking requests
+    when max_events events have been collected or flush_interval seconds have passed
+    since the first buffered event.
+
+    Events with extra headers (e.g. DNT) can't be sent in bulk and are sent one by one.
+    '''
+    def __init__(self, max_events=MAX_EVENTS_PER_MATOMO_REQUEST, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.max_events = max_events
+        self.flush_interval = flush_interval
+        self.events = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, event, extra_headers=None):
+        if extra_headers:
+            get_tracking_dispatcher().submit(matomo_track, event, extra_headers)
+            return
+
+        batch = None
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) >= self.max_events:
+                batch = self._take()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if batch:
+            get_tracking_dispatcher().submit(matomo_track_bulk, batch, events=len(batch))
+
+    def flush(self, wait=False):
+        '''
+        Sends all buffered events, synchronously if wait is set
+        '''
+        with self.lock:
+            batch = self._take()
+
+        if batch:
+            if wait:
+                matomo_track_bulk(batch)
+            else:
+                get_tracking_dispatcher().submit(matomo_track_bulk, batch, events=len(batch))
+
+    def _take(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.events = self.events, []
+        return batch
+
+
+_tracking_buffer = None
+_tracking_buffer_lock = threading.Lock()
+
+
+def tracking_buffer_options(config) -> Dict[str, Any]:
+    '''
+    Reads TrackingBuffer options from config, raises ValueError for invalid values
+    '''
+    options = {
+        'max_events': toolkit.asint(config.get('ckanext.matomo.tracking_batch_size', MAX_EVENTS_PER_MATOMO_REQUEST)),
+        'flush_interval': float(config.get('ckanext.matomo.tracking_flush_interval', DEFAULT_FLUSH_INTERVAL)),
+    }
+    if options['max_events'] < 1:
+        raise ValueError('Tracking batch size must be at least 1')
+    return options
+
+
+def get_tracking_buffer() -> TrackingBuffer:
+    global _tracking_buffer
+    if _tracking_buffer is None:
+        with _tracking_buffer_lock:
+            if _tracking_buffer is None:
+                _tracking_buffer = TrackingBuffer(**tracking_buffer_options(toolkit.config))
+    return _tracking_buffer
+
+
+_tracking_spool = None
+_tracking_spool_lock = threading.Lock()
+
+
+def get_tracking_spool():
+    '''
+    Returns the on-disk tracking spool or None if ckanext.matomo.tracking_spool_dir is not set
+    '''
+    global _tracking_spool
+    spool_dir = toolkit.config.get('ckanext.matomo.tracking_spool_dir')
+    if not spool_dir:
+        return None
+    if _tracking_spool is None:
+        with _tracking_spool_lock:
+            if _tracking_spool is None:
+                os.makedirs(spool_dir, exist_ok=True)
+                _tracking_spool = TrackingSpool(spool_dir)
+    return _tracking_spool
+
+
+def flush_tracking_spool(batch_size=MAX_EVENTS_PER_MATOMO_REQUEST):
+    '''
+    Sends spooled tracking events to Matomo in bulk until the spool is empty or sending fails
+
+    :return: {'sent': int, 'failed': int}
+    '''
+    spool = get_tracking_spool()
+    if spool is None:
+        raise RuntimeError('ckanext.matomo.tracking_spool_dir is not set')
+
+    result = {'sent': 0, 'failed': 0}
+    while True:
+        claimed = spool.claim(batch_size)
+        if not claimed:
+            return result
+
+        sent_ids = []
+        bulk_ids, bulk_events = [], []
+        for event_id, event, extra_headers in claimed:
+            # Events with extra headers can't be sent in bulk
+            if extra_headers:
+                if matomo_track(event, extra_headers):
+                    sent_ids.append(event_id)
+            else:
+                bulk_ids.append(event_id)
+                bulk_events.append(event)
+        if bulk_events:
+            failed_indices = set(matomo_track_bulk_failures(bulk_events))
+            sent_ids.extend(event_id for index, event_id in enumerate(bulk_ids) if index not in failed_indices)
+
+        spool.remove(sent_ids)
+        result['sent'] += len(sent_ids)
+        if len(sent_ids) < len(claimed):
+            sent = set(sent_ids)
+            failed_ids = [event_id for event_id, _event, _headers in claimed if event_id not in sent]
+            spool.release(failed_ids)
+            result['failed'] += len(failed_ids)
+            return result
+
+
+@atexit.register
+def flush_tracking_buffer():
+    # Sender threads are daemons and stop at interpreter shutdown, so send remaining events directly
+    # for at most the drain timeout
+    if _tracking_dispatcher is not None:
+        _tracking_dispatcher.drain()
+    if _tracking_buffer is not None:
+        _tracking_buffer.flush(wait=True)
 
 
 def tracked_action(logic_function, ver=3):
@@ -61,7 +378,13 @@ def post_analytics(category, action, name, download=False):
         headers = {'dnt': toolkit.request.headers.get('DNT')}
 
     log.info('Logging tracking event: %s', event)
-    tracking_executor.submit(matomo_track, event, headers)
+    spool = get_tracking_spool()
+    if spool is not None:
+        # Spooled events may be sent much later, so record the time of the request
+        event['cdt'] = int(time.time())
+        spool.append(event, headers)
+    else:
+        get_tracking_buffer().add(event, headers)
 
 
 # Required to be a free function to work with background jobs
@@ -75,14 +398,69 @@ def matomo_track(event, extra_headers=None):
 
     if test_mode:
         log.info(f"Would send API event to Matomo: {event}")
-        return
+        return True
 
     log.info(f"Sending API event to Matomo: {event}")
-    matomo_url = toolkit.config.get(u'ckanext.matomo.domain')
-    matomo_site_id = toolkit.config.get(u'ckanext.matomo.site_id')
-    token_auth = toolkit.config.get('ckanext.matomo.token_auth')
-    api = MatomoAPI(matomo_url, matomo_site_id, token_auth=token_auth)
-    r = api.tracking(event, extra_headers=extra_headers)
+    try:
+        r = _tracking_api().tracking(event, extra_headers=extra_headers)
+    except requests.RequestException as e:
+        log.warning('Error when posting tracking events to matomo: %s' % e)
+        return False
     if not r.ok:
         log.warn('Error when posting tracking events to matomo: %s %s' % (r.status_code, r.reason))
         log.warn('With request: %s' % r.url)
+    return r.ok
+
+
+def matomo_track_bulk(events):
+    return not matomo_track_bulk_failures(events)
+
+
+def matomo_track_bulk_failures(events) -> List[int]:
+    '''
+    Sends the events with a single bulk tracking request
+
+    :return: indices of the events Matomo did not track, all of them if the request failed
+    '''
+    log = logging.getLogger('ckanext.matomo.tracking')
+    test_mode = toolkit.config.get('ckanext.matomo.test_mode', False)
+    all_indices = list(range(len(events)))
+
+    if test_mode:
+        log.info(f"Would send {len(events)} API events to Matomo")
+        return []
+
+    log.info(f"Sending {len(events)} API events to Matomo")
+    try:
+        r = _tracking_api().tracking_bulk(events)
+    except requests.RequestException as e:
+        log.warning('Error when posting tracking events to matomo: %s' % e)
+        return all_indices
+    if not r.ok:
+        log.warn('Error when posting tracking events to matomo: %s %s' % (r.status_code, r.reason))
+        return all_indices
+
+    # Matomo responds 200 even if it rejected some of the events
+    try:
+        result = r.json()
+        tracked, invalid = int(result.get('tracked', 0)), int(result.get('invalid', 0))
+    except (ValueError, TypeError, AttributeError):
+        log.warning('Unexpected response to bulk tracking request: %.200s', r.text)
+        return all_indices
+    if invalid == 0 and tracked == len(events):
+        return []
+
+    log.warning('Matomo tracked %d of %d events, %d were invalid', tracked, len(events), invalid)
+    # Newer Matomo versions tell which events were invalid
+    invalid_indices = result.get('invalid_indices')
+    if isinstance(invalid_indices, list) and tracked + len(invalid_indices) == len(events):
+        return sorted(index for index in invalid_indices if index in all_indices)
+    return all_indices
+
+
+def _tracking_api() -> MatomoAPI:
+    matomo_url = toolkit.config.get(u'ckanext.matomo.domain')
+    matomo_site_id = toolkit.config.get(u'ckanext.matomo.site_id')
+    token_auth = toolkit.config.get('ckanext.matomo.token_auth')
+    timeout = float(toolkit.config.get('ckanext.matomo.tracking_timeout', DEFAULT_TRACKING_TIMEOUT))
+    return MatomoAPI(matomo_url, matomo_site_id, token_auth=token_auth, timeout=timeout)
@@ -35,11 +35,10 @@ VisitsByOrganization = TypedDict('VisitsByOrganization', {
     'downloads': int,
     'events': int
 }, total=False)
+PagedReportOptions = Dict[Literal['organization', 'time', 'page', 'limit', 'sort_by'], Optional[str]]
 GroupedVisits = Dict[str, Visit]
 Report = TypedDict('Report', {'report_name': str,
-                   'table': Union[List[VisitsByOrganization], List[VisitsByPackage], List[VisitsByResource]]}, total=False)
-Resource = TypedDict('Resource', {'resource_id': str, 'resource_name': str,
-                                  'resource_name_translated': Optional[LocalizationObject], 'package_id': str,
-                                  'package_name': str, 'package_title': str,
-                                  'package_title_translated': Optional[LocalizationObject],
-                                  'owner_org': Optional[str]})
+                   'table': Union[List[VisitsByOrganization], List[VisitsByPackage], List[VisitsByResource]],
+                   'total': int, 'page': int, 'limit': Optional[int], 'sort_by': str}, total=False)
+PackageInfo = TypedDict('PackageInfo', {'id': str, 'name': str, 'type': str, 'owner_org': Optional[str]})
+ResourceInfo = TypedDict('ResourceInfo', {'package_id': str, 'state': str})
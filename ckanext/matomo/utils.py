@@ -2,32 +2,10 @@
 
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
-from typing import Dict, Any, List, Generator, Union, Tuple
-import itertools
-from ckan.plugins.toolkit import get_action
+from typing import List, Union, Tuple
 
 log = __import__('logging').getLogger(__name__)
 
-def package_generator(query, page_size, fq='', fl=None,
-                      context={'ignore_auth': True},
-                      dataset_type='dataset') -> Generator[Any, None, None]:
-    package_search = get_action('package_search')
-
-    # Loop through all items. Each page has {page_size} items.
-    # Stop iteration when all items have been looped.
-    for index in itertools.count(start=0, step=page_size):
-        data_dict: Dict[str, Any] = {'rows': page_size, 'q': query, 'start': index,
-                     'fq': '+dataset_type:' + dataset_type + ' ' + fq,
-                     'fl': fl}
-        data: Dict[str, Any] = package_search(context, data_dict)
-        packages: List[Any] = data.get('results', [])
-        for package in packages:
-            yield package
-
-        # Stop iteration all query results have been looped through
-        if data["count"] < (index + page_size):
-            return
-
 
 def get_report_years() -> List[str]:
     start_year = 2014